@@ -0,0 +1,79 @@
+"""Перенос сигналов в signal_history и очистка старой истории.
+
+Всё делается короткими транзакциями по ARCHIVE_BATCH_SIZE строк, чтобы не
+держать долгих блокировок на signals/signal_history. История ограничивается
+сроком хранения HISTORY_RETENTION_DAYS (0 — хранить бессрочно); индекс по
+created_at (миграция 2) держит запрос истории в show_history на index scan.
+У строк истории свой id, исходный id сигнала лежит в signal_id (миграция 10).
+"""
+import asyncio
+import logging
+
+import db
+from config import ARCHIVE_BATCH_SIZE, HISTORY_RETENTION_DAYS, SIGNALS_ARCHIVE_AFTER_DAYS
+from signal_feed import feed
+
+
+async def archive_signals(older_than_days: int | None = None,
+                          batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Переносит сигналы (все или старше older_than_days) в историю, пачками по id."""
+    where, args = "", ()
+    if older_than_days is not None:
+        where, args = "AND created_at < NOW() - INTERVAL %s DAY", (older_than_days,)
+
+    moved, after = 0, 0
+    while True:
+        async with db.transaction() as conn:
+            rows = await conn.fetchall(
+                f"SELECT id FROM signals WHERE id > %s {where} ORDER BY id LIMIT %s FOR UPDATE",
+                (after, *args, batch_size)
+            )
+            if not rows:
+                break
+            ids = [row[0] for row in rows]
+            marks = ", ".join(["%s"] * len(ids))
+            # Копия и удаление в одной транзакции под FOR UPDATE: строка либо
+            # переносится целиком, либо остаётся в signals
+            await conn.execute(
+                "INSERT INTO signal_history (signal_id, text, created_at) "
+                f"SELECT id, text, created_at FROM signals WHERE id IN ({marks})",
+                ids
+            )
+            deleted = await conn.execute(f"DELETE FROM signals WHERE id IN ({marks})", ids)
+        moved += deleted
+        after = ids[-1]
+        feed.invalidate()
+        if len(ids) < batch_size:
+            break
+        await asyncio.sleep(0)  # дать поработать остальным корутинам между пачками
+
+    if moved:
+        logging.info("🗄 Archived %s signals", moved)
+    return moved
+
+
+async def prune_history(retention_days: int = HISTORY_RETENTION_DAYS,
+                        batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    if retention_days <= 0:
+        return 0
+    removed = 0
+    while True:
+        count = await db.execute(
+            "DELETE FROM signal_history WHERE created_at < NOW() - INTERVAL %s DAY "
+            "ORDER BY created_at LIMIT %s",
+            (retention_days, batch_size)
+        )
+        removed += count
+        if count < batch_size:
+            break
+        await asyncio.sleep(0)
+    if removed:
+        logging.info("🧹 Pruned %s history rows older than %s days", removed, retention_days)
+    return removed
+
+
+async def run_maintenance():
+    """Ежедневная задача планировщика."""
+    if SIGNALS_ARCHIVE_AFTER_DAYS > 0:
+        await archive_signals(older_than_days=SIGNALS_ARCHIVE_AFTER_DAYS)
+    await prune_history()
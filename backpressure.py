@@ -0,0 +1,150 @@
+"""Ограничение нагрузки от тяжёлых хэндлеров (сигналы, история, покупка, …).
+
+Для хэндлеров из списка guarded, в порядке проверки:
+- повтор того же нажатия/текста, пока первое ещё обрабатывается, сразу
+  отбрасывается — не тратит ни токенов, ни запросов в БД;
+- у каждого пользователя token bucket: BACKPRESSURE_USER_RATE в секунду,
+  запас BACKPRESSURE_USER_BURST;
+- одновременно выполняется не больше BACKPRESSURE_MAX_INFLIGHT таких
+  хэндлеров, остальные ждут слот до BACKPRESSURE_WAIT секунд и отбрасываются.
+
+Отброшенное считается в bot_shed_total{handler, event, reason}. На нажатие кнопки
+отвечает всплывающая подсказка, на сообщения — не чаще раза в WARN_INTERVAL.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Iterable
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+
+import metrics
+from config import (
+    BACKPRESSURE_USER_RATE, BACKPRESSURE_USER_BURST, BACKPRESSURE_MAX_INFLIGHT, BACKPRESSURE_WAIT,
+)
+
+DUPLICATE, RATE, OVERLOAD = "duplicate", "rate", "overload"
+
+MAX_TRACKED_USERS = 100_000
+WARN_INTERVAL     = 10.0
+
+NOTICES = {
+    DUPLICATE: "⏳ Уже обрабатываю…",
+    RATE:      "⏳ Не так быстро, подождите пару секунд.",
+    OVERLOAD:  "⚠️ Бот перегружен, попробуйте чуть позже.",
+}
+
+SHED = metrics.Counter("bot_shed_total", "Updates dropped by backpressure", ("handler", "event", "reason"))
+
+
+class Backpressure:
+    def __init__(self, rate: float = BACKPRESSURE_USER_RATE, burst: float = BACKPRESSURE_USER_BURST,
+                 max_inflight: int = BACKPRESSURE_MAX_INFLIGHT, wait: float = BACKPRESSURE_WAIT):
+        self.rate = rate
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self.wait = wait
+        # user_id -> [токены, момент пересчёта, момент последнего предупреждения]
+        self._buckets: "OrderedDict[int, list[float]]" = OrderedDict()
+        self._running: set[tuple] = set()
+        self._slots = asyncio.Semaphore(max_inflight)
+        self.inflight = 0
+
+    def _bucket(self, user_id: int) -> list[float]:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [self.burst, time.monotonic(), 0.0]
+            while len(self._buckets) > MAX_TRACKED_USERS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket
+
+    def begin(self, key: tuple) -> bool:
+        """False, если такое же нажатие уже обрабатывается."""
+        if key in self._running:
+            return False
+        self._running.add(key)
+        return True
+
+    def end(self, key: tuple):
+        self._running.discard(key)
+
+    def take(self, user_id: int) -> bool:
+        bucket = self._bucket(user_id)
+        now = time.monotonic()
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def should_warn(self, user_id: int) -> bool:
+        bucket = self._bucket(user_id)
+        now = time.monotonic()
+        if now - bucket[2] < WARN_INTERVAL:
+            return False
+        bucket[2] = now
+        return True
+
+    async def acquire(self) -> bool:
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.wait)
+        except asyncio.TimeoutError:
+            return False
+        self.inflight += 1
+        return True
+
+    def release(self):
+        self.inflight -= 1
+        self._slots.release()
+
+
+backpressure = Backpressure()
+
+metrics.Gauge("bot_guarded_handlers_inflight", "Guarded handlers running now", fn=lambda: backpressure.inflight)
+
+
+class BackpressureMiddleware(BaseMiddleware):
+    """Inner middleware, первым в цепочке: хэндлер уже выбран фильтрами,
+    а отброшенный апдейт не доходит до загрузки контекста."""
+
+    def __init__(self, event: str, guarded: Iterable[Callable]):
+        self.event = event
+        self.guarded = frozenset(guarded)
+
+    async def _reject(self, event: TelegramObject, user_id: int, name: str, reason: str):
+        SHED.inc(name, self.event, reason)
+        if isinstance(event, CallbackQuery):
+            await event.answer(NOTICES[reason])
+        elif reason != DUPLICATE and backpressure.should_warn(user_id):
+            await event.answer(NOTICES[reason])
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        handler_obj = data.get("handler")
+        if user is None or handler_obj is None or handler_obj.callback not in self.guarded:
+            return await handler(event, data)
+
+        name = handler_obj.callback.__name__
+        key = (user.id, name, getattr(event, "data", None) or getattr(event, "text", None))
+        if not backpressure.begin(key):
+            return await self._reject(event, user.id, name, DUPLICATE)
+        try:
+            if not backpressure.take(user.id):
+                return await self._reject(event, user.id, name, RATE)
+            if not await backpressure.acquire():
+                return await self._reject(event, user.id, name, OVERLOAD)
+            try:
+                return await handler(event, data)
+            finally:
+                backpressure.release()
+        finally:
+            backpressure.end(key)
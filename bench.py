@@ -0,0 +1,485 @@
+"""Нагрузочный прогон бота против локальных заглушек Telegram Bot API и NOWPayments.
+
+    python bench.py --users 500 --concurrency 50
+    python bench.py --users 500 --compare bench_results/<предыдущий>.json
+
+Синтетические апдейты идут через настоящий Dispatcher с register_handlers,
+IPN — HTTP-запросами в create_app. Сценарии по фазам:
+регистрация (/start → язык → имя → email), «Сигналы» без подписки, покупка,
+IPN об оплате (каждому второму), «Сигналы» с подпиской, рассылка напоминаний.
+
+Для каждой фазы считаются p50/p95/p99 латентности, апдейты в секунду и
+обращения к MySQL на апдейт. Результат пишется в bench_results/<время>-<commit>.json.
+
+Нужна отдельная база (по умолчанию <DB_NAME>_bench, см. --db): миграции
+накатываются на неё автоматически, строки бенчмарка удаляются до и после прогона.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:BENCH")
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+import db
+import ipn_worker
+import metrics
+import migrations
+import payments
+from config import DB_CFG
+from handlers import register_handlers
+from locale_utils import load_messages
+from remind import remind_unpaid_users
+from signal_delivery import cursors
+from signal_feed import feed
+
+BENCH_USER_BASE = 7_000_000_000
+BENCH_SIGNAL    = "[bench] "
+BENCH_TOKEN     = "123456:BENCH"
+RESULTS_DIR     = "bench_results"
+
+
+# ─── Заглушка Telegram Bot API ────────────────────────────────────────────────
+class FakeTelegram:
+    """Отвечает на методы Bot API так, как это нужно aiogram: send/edit
+    возвращают Message, остальное — True. latency добавляет задержку сети,
+    flood_every — каждый N-й ответ 429 с retry_after=1."""
+
+    def __init__(self, latency: float = 0.0, flood_every: int = 0):
+        self.latency = latency
+        self.flood_every = flood_every
+        self.calls: dict[str, int] = {}
+        self._ids = itertools.count(1)
+        self._n = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self._n += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_every and self._n % self.flood_every == 0:
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+
+        form = await request.post()
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(form.get("chat_id") or 0)
+            result = {
+                "message_id": int(form.get("message_id") or next(self._ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": form.get("text", ""),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+# ─── Заглушка NOWPayments ─────────────────────────────────────────────────────
+class FakeNowPayments:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.subscriptions: dict[str, str] = {}  # email → subscription_id
+        self._ids = itertools.count(1)
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def auth(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.json_response({"token": "bench-jwt"})
+
+    async def subscribe(self, request: web.Request) -> web.Response:
+        await self._delay()
+        body = await request.json()
+        sub_id = self.subscriptions.setdefault(body["email"], f"bench-{next(self._ids)}")
+        return web.json_response({"result": [{"id": sub_id, "email": body["email"]}]})
+
+    async def invoices(self, request: web.Request) -> web.Response:
+        await self._delay()
+        sub_id = request.match_info["sub_id"]
+        return web.json_response({"result": [{"invoice_url": f"https://pay.example/{sub_id}"}]})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/auth", self.auth)
+        app.router.add_post("/subscriptions", self.subscribe)
+        app.router.add_get("/subscriptions/{sub_id}/invoices", self.invoices)
+        return app
+
+
+async def serve(app: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+# ─── Синтетические апдейты ────────────────────────────────────────────────────
+_update_ids = itertools.count(1)
+
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": "Bench", "username": f"bench{uid}"}
+
+
+def _message(uid: int, text: str) -> dict:
+    return {
+        "message_id": next(_update_ids),
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private"},
+        "from": _user(uid),
+        "text": text,
+    }
+
+
+def message_update(uid: int, text: str) -> dict:
+    return {"update_id": next(_update_ids), "message": _message(uid, text)}
+
+
+def callback_update(uid: int, data: str) -> dict:
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(uid),
+            "chat_instance": "bench",
+            "data": data,
+            "message": _message(uid, "bench"),
+        },
+    }
+
+
+# ─── Замеры ───────────────────────────────────────────────────────────────────
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+@dataclass
+class Phase:
+    name: str
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+    elapsed: float = 0.0
+    round_trips: int = 0
+
+    def report(self) -> dict:
+        count = len(self.latencies)
+        return {
+            "count": count,
+            "errors": self.errors,
+            "elapsed_s": round(self.elapsed, 3),
+            "per_sec": round(count / self.elapsed, 1) if self.elapsed else 0.0,
+            "p50_ms": round(percentile(self.latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(self.latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(self.latencies, 99) * 1000, 2),
+            "db_round_trips": self.round_trips,
+            "db_per_op": round(self.round_trips / count, 2) if count else 0.0,
+        }
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.users = [BENCH_USER_BASE + i for i in range(args.users)]
+        self.telegram = FakeTelegram(args.tg_latency / 1000, args.tg_flood_every)
+        self.nowpayments = FakeNowPayments(args.np_latency / 1000)
+        self.phases: list[Phase] = []
+        self.runners: list[web.AppRunner] = []
+        self.bot: Bot | None = None
+        self.dp: Dispatcher | None = None
+        self.ipn_url = ""
+
+    async def _run_phase(self, name: str, jobs, concurrency: int) -> Phase:
+        """jobs — по одной корутин-фабрике на пользователя; шаги внутри
+        пользователя идут последовательно (FSM), пользователи — параллельно."""
+        phase = Phase(name)
+        slots = asyncio.Semaphore(concurrency)
+
+        async def run(job):
+            async with slots:
+                await job(phase)
+
+        before = db.round_trips()
+        started = time.perf_counter()
+        await asyncio.gather(*(run(job) for job in jobs))
+        phase.elapsed = time.perf_counter() - started
+        phase.round_trips = db.round_trips() - before
+        self.phases.append(phase)
+        logging.info("⏱ %s: %s", name, phase.report())
+        return phase
+
+    async def _feed(self, phase: Phase, raw: dict):
+        update = Update.model_validate(raw, context={"bot": self.bot})
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            phase.errors += 1
+            logging.exception("❌ Update failed")
+        phase.latencies.append(time.perf_counter() - started)
+
+    def _steps(self, *steps):
+        async def job(phase: Phase):
+            for raw in steps:
+                await self._feed(phase, raw)
+        return job
+
+    # ─── Фазы ────────────────────────────────────────────────────────────────
+    async def registration(self):
+        await self._run_phase("registration", [
+            self._steps(
+                message_update(uid, "/start"),
+                callback_update(uid, "lang:en"),
+                message_update(uid, f"bench{uid}"),
+                message_update(uid, f"bench{uid}@example.com"),
+            )
+            for uid in self.users
+        ], self.args.concurrency)
+
+    async def signals(self, name: str):
+        button = load_messages("en")["signals_button"]
+        await self._run_phase(name, [
+            self._steps(message_update(uid, button)) for uid in self.users
+        ], self.args.concurrency)
+
+    async def buy(self):
+        await self._run_phase("buy", [
+            self._steps(callback_update(uid, "buy:monthly")) for uid in self.users
+        ], self.args.concurrency)
+
+    async def ipn(self):
+        paid = [
+            self.nowpayments.subscriptions[f"bench{uid}@example.com"]
+            for uid in self.users[::2]
+            if f"bench{uid}@example.com" in self.nowpayments.subscriptions
+        ]
+        async with aiohttp.ClientSession() as session:
+            def job(n: int, sub_id: str):
+                async def post(phase: Phase):
+                    data = {"payment_id": f"bench-pay-{n}", "payment_status": "finished",
+                            "subscription_id": sub_id}
+                    body = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+                    headers = {"Content-Type": "application/json", "x-nowpayments-sig": hmac.new(
+                        payments.IPN_SECRET.encode(), body.encode(), hashlib.sha512
+                    ).hexdigest()}
+                    started = time.perf_counter()
+                    async with session.post(self.ipn_url, data=body, headers=headers) as resp:
+                        await resp.read()
+                        if resp.status != 200:
+                            phase.errors += 1
+                    phase.latencies.append(time.perf_counter() - started)
+                return post
+
+            await self._run_phase("ipn_accept", [job(n, s) for n, s in enumerate(paid)],
+                                  self.args.concurrency)
+
+        # Время, за которое воркеры применили все принятые события
+        phase = Phase("ipn_apply")
+        before = db.round_trips()
+        started = time.perf_counter()
+        await ipn_worker.stop(timeout=300)
+        phase.elapsed = time.perf_counter() - started
+        phase.round_trips = db.round_trips() - before
+        phase.latencies.append(phase.elapsed)
+        self.phases.append(phase)
+        await ipn_worker.start(self.bot)
+
+    async def reminders(self):
+        phase = Phase("remind_unpaid")
+        before = db.round_trips()
+        stats = await remind_unpaid_users(self.bot)
+        phase.elapsed = stats.elapsed
+        phase.round_trips = db.round_trips() - before
+        phase.latencies = [0.0] * stats.sent  # одна «операция» — одно отправленное сообщение
+        phase.errors = stats.failed
+        self.phases.append(phase)
+        logging.info("⏱ remind_unpaid: %s", stats.summary())
+
+    # ─── Подготовка и уборка ─────────────────────────────────────────────────
+    async def cleanup(self):
+        low, high = BENCH_USER_BASE, BENCH_USER_BASE + 10**9
+        async with db.acquire() as conn:
+            for table in ("ipn_events", "subscription_payments"):
+                await conn.execute(
+                    f"DELETE FROM {table} WHERE subscription_id IN "
+                    "(SELECT subscription_id FROM subscriptions WHERE user_id BETWEEN %s AND %s)",
+                    (low, high)
+                )
+            for table in ("subscriptions", "signal_cursors", "blocked_users", "admins", "users"):
+                await conn.execute(f"DELETE FROM {table} WHERE user_id BETWEEN %s AND %s", (low, high))
+            await conn.execute("DELETE FROM signal_deliveries WHERE user_id BETWEEN %s AND %s", (low, high))
+            await conn.execute("DELETE FROM signals WHERE text LIKE %s", (BENCH_SIGNAL + "%",))
+            await conn.execute("DELETE FROM broadcast_checkpoints WHERE job = 'remind_unpaid'")
+        feed.invalidate()
+
+    async def seed_signals(self):
+        async with db.acquire() as conn:
+            await conn.executemany(
+                "INSERT INTO signals(text) VALUES (%s)",
+                [(f"{BENCH_SIGNAL}BTC/USDT long #{i}",) for i in range(self.args.signals)]
+            )
+        feed.invalidate()
+
+    async def setup(self):
+        DB_CFG["database"] = self.args.db
+        await db.init_pool()
+        await migrations.upgrade()
+        await self.cleanup()
+        await self.seed_signals()
+
+        runner, telegram_url = await serve(self.telegram.app())
+        self.runners.append(runner)
+        runner, nowpayments_url = await serve(self.nowpayments.app())
+        self.runners.append(runner)
+        payments.BASE_URL = nowpayments_url  # клиент создаётся лениво, при первой покупке
+        payments.IPN_SECRET = payments.IPN_SECRET or "bench"  # неподписанные IPN отклоняются
+        runner, app_url = await serve(payments.create_app())
+        self.runners.append(runner)
+        self.ipn_url = app_url + payments.IPN_ROUTE
+
+        session = AiohttpSession(api=TelegramAPIServer.from_base(telegram_url))
+        self.bot = metrics.instrument_bot(Bot(token=BENCH_TOKEN, session=session))
+        self.dp = Dispatcher()
+        register_handlers(self.dp, self.bot)
+
+        await ipn_worker.start(self.bot)
+        await cursors.start()
+
+    async def teardown(self):
+        await ipn_worker.stop()
+        await cursors.stop()
+        if not self.args.keep:
+            await self.cleanup()
+        for runner in reversed(self.runners):
+            await runner.cleanup()
+        await payments.close_client()
+        if self.bot:
+            await self.bot.session.close()
+        await db.close_pool()
+
+    async def run(self) -> dict:
+        await self.setup()
+        try:
+            await self.registration()
+            await self.signals("signals_unpaid")
+            await self.buy()
+            await self.ipn()
+            await self.signals("signals_paid")
+            await self.reminders()
+        finally:
+            await self.teardown()
+
+        updates = [p for p in self.phases if p.name not in ("ipn_apply", "remind_unpaid")]
+        total = Phase("updates_total", elapsed=sum(p.elapsed for p in updates),
+                      round_trips=sum(p.round_trips for p in updates))
+        for p in updates:
+            total.latencies.extend(p.latencies)
+            total.errors += p.errors
+        return {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": {k: v for k, v in vars(self.args).items() if k not in ("compare", "out")},
+            "telegram_calls": self.telegram.calls,
+            "phases": {p.name: p.report() for p in [*self.phases, total]},
+        }
+
+
+# ─── Результаты ───────────────────────────────────────────────────────────────
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save(result: dict, directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    stamp = result["timestamp"].replace(":", "").replace("-", "")
+    path = os.path.join(directory, f"{stamp}-{result['commit']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    return path
+
+
+METRICS = ("per_sec", "p50_ms", "p95_ms", "p99_ms", "db_per_op")
+
+
+def print_table(result: dict, baseline: dict | None = None):
+    print(f"\ncommit {result['commit']}" + (f" vs {baseline['commit']}" if baseline else ""))
+    print(f"{'phase':<16}{'count':>7}{'err':>5}" + "".join(f"{m:>18}" for m in METRICS))
+    for name, cur in result["phases"].items():
+        base = (baseline or {}).get("phases", {}).get(name)
+        cells = []
+        for m in METRICS:
+            cell = f"{cur[m]:g}"
+            if base and base.get(m):
+                cell += f" ({(cur[m] - base[m]) / base[m] * 100:+.0f}%)"
+            cells.append(f"{cell:>18}")
+        print(f"{name:<16}{cur['count']:>7}{cur['errors']:>5}" + "".join(cells))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against fake Telegram/NOWPayments")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--signals", type=int, default=20, help="signals seeded into the feed")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="fake Telegram latency, ms")
+    parser.add_argument("--tg-flood-every", type=int, default=0, help="answer 429 to every N-th call")
+    parser.add_argument("--np-latency", type=float, default=0.0, help="fake NOWPayments latency, ms")
+    parser.add_argument("--db", default=os.getenv("BENCH_DB_NAME", f"{DB_CFG['database']}_bench"))
+    parser.add_argument("--keep", action="store_true", help="keep benchmark rows after the run")
+    parser.add_argument("--out", default=RESULTS_DIR)
+    parser.add_argument("--compare", help="previous result file to diff against")
+    args = parser.parse_args()
+
+    if args.db == DB_CFG["database"]:
+        print("Refusing to benchmark against the production database; pass --db", file=sys.stderr)
+        return 2
+
+    result = asyncio.run(Bench(args).run())
+    path = save(result, args.out)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_table(result, baseline)
+    print(f"\nSaved to {path}")
+    return 1 if any(p["errors"] for p in result["phases"].values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
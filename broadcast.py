@@ -0,0 +1,286 @@
+import asyncio
+import collections
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterable, Callable, Iterable
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramRetryAfter, TelegramServerError,
+)
+
+import db
+import metrics
+from config import BROADCAST_CONCURRENCY, BROADCAST_RATE, BROADCAST_MAX_RETRIES
+
+# Telegram: ~30 msg/s на бота и не чаще 1 msg/s в один чат
+SENT, BLOCKED, FAILED = "sent", "blocked", "failed"
+
+Recipients = Iterable | AsyncIterable | Callable[[int], AsyncIterable]
+
+PER_CHAT_INTERVAL = 1.0
+CHECKPOINT_EVERY  = 200
+RESUME_WINDOW     = 6 * 3600
+PROGRESS_EVERY    = 1000
+
+# ─── Rate limiter ─────────────────────────────────────────────────────────────
+class TokenBucket:
+    """Глобальный token bucket. pause() останавливает всех ожидающих —
+    так RetryAfter от Telegram применяется ко всей рассылке, а не к одному воркеру."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated = time.monotonic()
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# ─── Статистика ───────────────────────────────────────────────────────────────
+@dataclass
+class BroadcastStats:
+    job: str
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    skipped: int = 0
+    retries: int = 0
+    flood_waits: int = 0
+    resumed_from: int | None = None
+    started: float = field(default_factory=time.monotonic)
+    finished: float | None = None
+    first_sent: float | None = None
+    last_sent: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        text = (
+            f"{self.job}: {self.sent}/{self.total} отправлено, "
+            f"{self.failed} ошибок, {self.blocked} заблокировали бота, "
+            f"{self.skipped} пропущено, {self.retries} повторов, "
+            f"{self.flood_waits} flood-wait; "
+            f"{self.elapsed:.1f} c, {self.rate:.1f} msg/s"
+        )
+        if self.resumed_from is not None:
+            text += f" (продолжено после user_id {self.resumed_from})"
+        return text
+
+
+# ─── Чекпоинты ────────────────────────────────────────────────────────────────
+class _Checkpoint:
+    """Low-water mark: наибольший user_id, до которого включительно всё обработано.
+    Получатели идут по возрастанию user_id, воркеры завершаются в любом порядке.
+    С persist=False (рассылка без resume) в broadcast_checkpoints ничего не пишется."""
+
+    def __init__(self, job: str, persist: bool = True):
+        self.job = job
+        self.persist = persist
+        self._order = collections.deque()
+        self._done = set()
+        self.mark = None
+        self._since_save = 0
+
+    def dispatched(self, uid: int):
+        self._order.append(uid)
+
+    def completed(self, uid: int):
+        self._done.add(uid)
+        while self._order and self._order[0] in self._done:
+            self.mark = self._order.popleft()
+            self._done.discard(self.mark)
+        self._since_save += 1
+
+    def due(self) -> bool:
+        return self.persist and self._since_save >= CHECKPOINT_EVERY and self.mark is not None
+
+    async def load(self) -> int | None:
+        row = await db.fetchone(
+            "SELECT last_user_id FROM broadcast_checkpoints "
+            "WHERE job=%s AND updated_at > NOW() - INTERVAL %s SECOND",
+            (self.job, RESUME_WINDOW)
+        )
+        return row[0] if row else None
+
+    async def save(self):
+        self._since_save = 0
+        if not self.persist:
+            return
+        await db.execute(
+            "INSERT INTO broadcast_checkpoints (job, last_user_id, updated_at) VALUES (%s, %s, NOW()) "
+            "ON DUPLICATE KEY UPDATE last_user_id = VALUES(last_user_id), updated_at = NOW()",
+            (self.job, self.mark)
+        )
+
+    async def clear(self):
+        if self.persist:
+            await db.execute("DELETE FROM broadcast_checkpoints WHERE job=%s", (self.job,))
+
+
+async def mark_blocked(user_id: int):
+    await db.execute(
+        "INSERT IGNORE INTO blocked_users (user_id, blocked_at) VALUES (%s, NOW())",
+        (user_id,)
+    )
+
+
+# ─── Движок рассылки ──────────────────────────────────────────────────────────
+# Один на процесс: лимит Telegram общий для бота, а не для отдельной рассылки
+telegram_limiter = TokenBucket(BROADCAST_RATE)
+
+
+class Broadcaster:
+    def __init__(self, bot: Bot, *, concurrency: int = BROADCAST_CONCURRENCY,
+                 rate: float | None = None, max_retries: int = BROADCAST_MAX_RETRIES,
+                 limiter: TokenBucket | None = None):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        # По умолчанию — общий лимит: параллельные рассылки делят BROADCAST_RATE
+        self.limiter = limiter or (TokenBucket(rate) if rate is not None else telegram_limiter)
+
+    async def _send(self, uid: int, payload: dict, stats: BroadcastStats) -> str:
+        attempt = 0
+        while True:
+            await self.limiter.acquire()
+            try:
+                await self.bot.send_message(uid, **payload)
+                stats.sent += 1
+                stats.last_sent = time.monotonic()
+                if stats.first_sent is None:
+                    stats.first_sent = stats.last_sent
+                return SENT
+            except TelegramRetryAfter as e:
+                stats.flood_waits += 1
+                logging.warning("⏳ Flood control, pausing broadcast for %ss", e.retry_after)
+                self.limiter.pause(e.retry_after)
+            except TelegramForbiddenError:
+                stats.blocked += 1
+                await mark_blocked(uid)
+                return BLOCKED
+            except TelegramBadRequest as e:
+                stats.failed += 1
+                logging.warning(f"❌ Не удалось отправить {uid}: {e}")
+                return FAILED
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    stats.failed += 1
+                    logging.warning(f"❌ Не удалось отправить {uid} после {attempt} попыток: {e}")
+                    return FAILED
+                stats.retries += 1
+                await asyncio.sleep(max(PER_CHAT_INTERVAL, 2 ** (attempt - 1)))
+
+    async def run(self, job: str, recipients: Recipients,
+                  build: Callable[..., dict | None], *, resume: bool = True,
+                  on_result: Callable[[int, dict, str], None] | None = None,
+                  stats: BroadcastStats | None = None) -> BroadcastStats:
+        """recipients — строки (user_id, language, *extra) по возрастанию user_id, либо
+        функция select(start_after), которая сама начинает выборку после чекпоинта;
+        build(user_id, language, *extra) возвращает kwargs для bot.send_message
+        или None, если этому получателю отправлять нечего;
+        on_result(user_id, payload, status) вызывается после каждой попытки доставки
+        (status — SENT, BLOCKED или FAILED); stats можно передать заранее, чтобы
+        следить за прогрессом снаружи."""
+        stats = stats or BroadcastStats(job)
+        checkpoint = _Checkpoint(job, persist=resume)
+        start_after = await checkpoint.load() if resume else None
+        stats.resumed_from = start_after
+
+        if callable(recipients):
+            recipients = recipients(start_after or 0)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                uid, payload = item
+                try:
+                    status = await self._send(uid, payload, stats)
+                except Exception:
+                    status = FAILED
+                    stats.failed += 1
+                    logging.exception(f"❌ Broadcast {job}: unexpected error for {uid}")
+                if on_result:
+                    on_result(uid, payload, status)
+                checkpoint.completed(uid)
+                if checkpoint.due():
+                    await checkpoint.save()
+                done = stats.sent + stats.failed + stats.blocked
+                if done % PROGRESS_EVERY == 0:
+                    logging.info("📤 %s: %s sent, %.1f msg/s", job, stats.sent, stats.rate)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            async for uid, lang, *extra in _aiter(recipients):
+                if start_after is not None and uid <= start_after:
+                    stats.skipped += 1
+                    continue
+                payload = build(uid, lang or "en", *extra)
+                if payload is None:
+                    stats.skipped += 1
+                    continue
+                stats.total += 1
+                checkpoint.dispatched(uid)
+                await queue.put((uid, payload))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except BaseException:
+            for w in workers:
+                w.cancel()
+            if checkpoint.mark is not None:
+                try:
+                    await checkpoint.save()
+                except Exception:
+                    logging.exception(f"❌ Broadcast {job}: failed to save checkpoint")
+            raise
+
+        await checkpoint.clear()
+        stats.finished = time.monotonic()
+        metrics.BROADCAST_SECONDS.observe(stats.elapsed, job)
+        metrics.BROADCAST_RATE.set(stats.rate, job)
+        for status, count in ((SENT, stats.sent), (BLOCKED, stats.blocked), (FAILED, stats.failed)):
+            metrics.BROADCAST_MESSAGES.inc(job, status, value=count)
+        logging.info("✅ Broadcast %s", stats.summary())
+        return stats
+
+
+async def _aiter(items):
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
@@ -0,0 +1,183 @@
+"""Оформление подписки по кнопке buy:<план> без повторных обращений к NOWPayments.
+
+На пару (пользователь, план) одновременно идёт не больше одного оформления:
+повторные нажатия, пока оно не закончилось, к нему присоединяются. Готовый
+неоплаченный счёт держится в памяти CHECKOUT_PENDING_TTL секунд, и повторное
+нажатие отвечает ссылкой сразу. После рестарта вместо новой удалённой
+подписки переиспользуется свежая WAITING_PAY из БД.
+
+Если NOWPayments ещё не выставил счёт, ссылку ждёт фоновая задача и присылает
+её сообщением, как только счёт появится (но не дольше CHECKOUT_POLL_TIMEOUT).
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+import db
+from broadcast import mark_blocked
+from config import CHECKOUT_PENDING_TTL, CHECKOUT_POLL_TIMEOUT
+from entitlements import refresh_active_until
+from payments import create_email_subscription, fetch_subscription_invoices
+from user_context import UserContext, invalidate
+
+REUSABLE_SQL = """
+    SELECT subscription_id FROM subscriptions
+     WHERE user_id = %s AND status = 'WAITING_PAY' AND plan_id = %s
+       AND created_at > NOW() - INTERVAL %s SECOND
+  ORDER BY created_at DESC
+     LIMIT 1
+"""
+
+INSERT_SQL = """
+    INSERT INTO subscriptions(subscription_id, user_id, plan_id, email, status, expire_at, created_at, updated_at)
+    VALUES (%s, %s, %s, %s, 'WAITING_PAY', DATE_ADD(NOW(), INTERVAL 30 DAY), NOW(), NOW())
+    ON DUPLICATE KEY UPDATE
+        status = 'WAITING_PAY',
+        expire_at = DATE_ADD(NOW(), INTERVAL 30 DAY),
+        updated_at = NOW()
+"""
+
+POLL_DELAYS = (2, 3, 5, 10, 15, 30)
+
+Key = tuple[int, str]
+
+
+async def _send(bot: Bot, user_id: int, text: str):
+    """Сообщение из фоновой задачи: ошибки логируются, а не теряются в задаче."""
+    for _ in range(3):
+        try:
+            await bot.send_message(user_id, text)
+            return
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError:
+            try:
+                await mark_blocked(user_id)
+            except Exception:
+                logging.exception(f"❌ Не удалось отметить {user_id} как заблокировавшего бота")
+            return
+        except Exception as e:
+            logging.warning(f"❌ Не удалось отправить сообщение об оплате {user_id}: {e}")
+            return
+
+
+class CheckoutError(Exception):
+    """Оформление не удалось; текст исключения показывается пользователю."""
+
+
+@dataclass
+class PendingInvoice:
+    subscription_id: str
+    url: str | None
+    # active_until на момент оформления: изменился — значит, была оплата
+    active_until: datetime | None
+    expires: float
+
+
+class Checkout:
+    def __init__(self, ttl: float = CHECKOUT_PENDING_TTL, poll_timeout: float = CHECKOUT_POLL_TIMEOUT):
+        self.ttl = ttl
+        self.poll_timeout = poll_timeout
+        self._pending: "OrderedDict[Key, PendingInvoice]" = OrderedDict()
+        self._inflight: dict[Key, asyncio.Task] = {}
+        self._polls: dict[Key, asyncio.Task] = {}
+
+    def cached(self, ctx: UserContext, plan_key: str) -> PendingInvoice | None:
+        key = (ctx.user_id, plan_key)
+        pending = self._pending.get(key)
+        if pending is None:
+            return None
+        if pending.expires <= time.monotonic() or pending.active_until != ctx.active_until:
+            self._pending.pop(key, None)
+            return None
+        return pending
+
+    def in_flight(self, user_id: int, plan_key: str) -> bool:
+        return (user_id, plan_key) in self._inflight
+
+    def _remember(self, key: Key, pending: PendingInvoice):
+        self._pending[key] = pending
+        self._pending.move_to_end(key)
+        # TTL у всех записей одинаковый, поэтому устаревшие — в начале
+        now = time.monotonic()
+        while self._pending:
+            oldest = next(iter(self._pending.values()))
+            if oldest.expires > now:
+                break
+            self._pending.popitem(last=False)
+
+    async def start(self, bot: Bot, ctx: UserContext, plan_key: str, plan: dict) -> PendingInvoice:
+        """Оформляет подписку или присоединяется к уже идущему оформлению."""
+        key = (ctx.user_id, plan_key)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._checkout(bot, ctx, key, plan))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: отменённый апдейт не должен обрывать оформление для остальных
+        return await asyncio.shield(task)
+
+    async def _subscription_id(self, ctx: UserContext, plan_id) -> str:
+        row = await db.fetchone(REUSABLE_SQL, (ctx.user_id, plan_id, int(self.ttl)))
+        if row:
+            logging.info(f"🔖 Reusing subscription ID: {row[0]}")
+            return row[0]
+
+        sub = await create_email_subscription(ctx.email, plan_id)
+        sub_id = sub.get("id")
+        if not sub_id:
+            raise CheckoutError("❌ Не удалось получить ID подписки.")
+        logging.info(f"🔖 Subscription ID: {sub_id}")
+
+        async with db.transaction() as conn:
+            await conn.execute(INSERT_SQL, (sub_id, ctx.user_id, plan_id, ctx.email))
+            await refresh_active_until(conn, ctx.user_id)
+        invalidate(ctx.user_id)
+        return sub_id
+
+    async def _checkout(self, bot: Bot, ctx: UserContext, key: Key, plan: dict) -> PendingInvoice:
+        sub_id = await self._subscription_id(ctx, plan["id"])
+        invs = await fetch_subscription_invoices(sub_id)
+        url = invs[0].get("invoice_url") if invs else None
+        pending = PendingInvoice(sub_id, url, ctx.active_until, time.monotonic() + self.ttl)
+        self._remember(key, pending)
+        if url is None and key not in self._polls:
+            task = asyncio.create_task(self._poll(bot, key, pending))
+            self._polls[key] = task
+            task.add_done_callback(lambda _: self._polls.pop(key, None))
+        return pending
+
+    async def _poll(self, bot: Bot, key: Key, pending: PendingInvoice):
+        user_id = key[0]
+        deadline = time.monotonic() + self.poll_timeout
+        attempt = 0
+        while time.monotonic() < deadline:
+            await asyncio.sleep(POLL_DELAYS[min(attempt, len(POLL_DELAYS) - 1)])
+            attempt += 1
+            try:
+                invs = await fetch_subscription_invoices(pending.subscription_id)
+            except Exception as e:
+                logging.warning("⚠️ Invoice poll for %s failed: %s", pending.subscription_id, e)
+                continue
+            if invs and invs[0].get("invoice_url"):
+                pending.url = invs[0]["invoice_url"]
+                await _send(bot, user_id, f"🔗 Оплатите подписку по ссылке:\n{pending.url}")
+                return
+
+        # Счёт так и не появился — следующее нажатие спросит NOWPayments заново
+        if self._pending.get(key) is pending:
+            del self._pending[key]
+        await _send(bot, user_id, "✅ Подписка создана, но счёт пока не готов. Попробуйте позже.")
+
+    async def stop(self):
+        for task in list(self._polls.values()):
+            task.cancel()
+
+
+checkout = Checkout()
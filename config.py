@@ -18,5 +18,98 @@ DB_CFG = {
     "database": os.getenv("DB_NAME"),
 }
 
+# Пул соединений с БД
+DB_POOL_MIN        = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX        = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT    = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))
+DB_BATCH_SIZE      = int(os.getenv("DB_BATCH_SIZE", "1000"))
+
+# Кэш контекста пользователя (язык, email, админ, подписка) на апдейт
+USER_CONTEXT_TTL = float(os.getenv("USER_CONTEXT_TTL", "30"))
+USER_CONTEXT_MAX = int(os.getenv("USER_CONTEXT_MAX", "10000"))
+
+# Рассылки
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_RATE        = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+# Курсоры доставки сигналов: пакетная запись
+CURSOR_FLUSH_INTERVAL = float(os.getenv("CURSOR_FLUSH_INTERVAL", "5"))
+CURSOR_FLUSH_SIZE     = int(os.getenv("CURSOR_FLUSH_SIZE", "1000"))
+CURSOR_CACHE_MAX      = int(os.getenv("CURSOR_CACHE_MAX", "100000"))
+
+# Архив сигналов
+ARCHIVE_BATCH_SIZE         = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+HISTORY_RETENTION_DAYS     = int(os.getenv("HISTORY_RETENTION_DAYS", "365"))
+SIGNALS_ARCHIVE_AFTER_DAYS = int(os.getenv("SIGNALS_ARCHIVE_AFTER_DAYS", "0"))
+
+# Истечение подписок: окно предзагрузки, размер пачки, за сколько дней предупреждать
+EXPIRY_HORIZON     = float(os.getenv("EXPIRY_HORIZON", "3600"))
+EXPIRY_BATCH_SIZE  = int(os.getenv("EXPIRY_BATCH_SIZE", "500"))
+EXPIRY_NOTICE_DAYS = tuple(int(d) for d in os.getenv("EXPIRY_NOTICE_DAYS", "3,1").split(",") if d.strip())
+
+# Сверка подписок с NOWPayments
+RECONCILE_CONCURRENCY  = int(os.getenv("RECONCILE_CONCURRENCY", "10"))
+RECONCILE_RATE         = float(os.getenv("RECONCILE_RATE", "5"))
+RECONCILE_PENDING_DAYS = int(os.getenv("RECONCILE_PENDING_DAYS", "7"))
+RECONCILE_ACTIVE_DAYS  = int(os.getenv("RECONCILE_ACTIVE_DAYS", "2"))
+
+# Оформление подписки: сколько держать неоплаченный счёт и ждать его появления
+CHECKOUT_PENDING_TTL  = float(os.getenv("CHECKOUT_PENDING_TTL", "1800"))
+CHECKOUT_POLL_TIMEOUT = float(os.getenv("CHECKOUT_POLL_TIMEOUT", "180"))
+
+# Отложенная запись профиля при регистрации (1 — включить): пачка раз в N мс или M пользователей
+USER_WRITE_BEHIND   = os.getenv("USER_WRITE_BEHIND", "0") == "1"
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "0.01"))
+USER_FLUSH_SIZE     = int(os.getenv("USER_FLUSH_SIZE", "500"))
+
+# Защита от перегрузки: лимит на пользователя (в секунду и запас) и общий лимит тяжёлых хэндлеров
+BACKPRESSURE_USER_RATE    = float(os.getenv("BACKPRESSURE_USER_RATE", "1"))
+BACKPRESSURE_USER_BURST   = float(os.getenv("BACKPRESSURE_USER_BURST", "5"))
+BACKPRESSURE_MAX_INFLIGHT = int(os.getenv("BACKPRESSURE_MAX_INFLIGHT", "50"))
+BACKPRESSURE_WAIT         = float(os.getenv("BACKPRESSURE_WAIT", "2"))
+
+# Фоновая обработка IPN
+IPN_WORKERS      = int(os.getenv("IPN_WORKERS", "4"))
+IPN_MAX_ATTEMPTS = int(os.getenv("IPN_MAX_ATTEMPTS", "5"))
+
+# Диагностика: сторож event loop и /debug-роуты (токен — в ?token=, пусто — роуты закрыты)
+LOOP_LAG_THRESHOLD    = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.05"))
+LOOP_STALL_HISTORY    = int(os.getenv("LOOP_STALL_HISTORY", "50"))
+DEBUG_TOKEN           = os.getenv("DEBUG_TOKEN")
+
+# Выборочное профилирование апдейтов (0 — выключено, 0.01 — каждый сотый)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL    = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_DIR         = os.getenv("PROFILE_DIR", "profiles")
+
+# FSM: mysql — состояние переживает рестарт и общее для воркеров, memory — как раньше
+FSM_STORAGE   = os.getenv("FSM_STORAGE", "mysql")
+FSM_CACHE_MAX = int(os.getenv("FSM_CACHE_MAX", "50000"))
+
+# Несколько процессов-воркеров: апдейты раскладываются по user_id
+WORKERS            = int(os.getenv("WORKERS", "1"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "100"))
+WORKER_QUEUE_SIZE  = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE            = os.getenv("BOT_MODE", "polling")
+HTTP_PORT           = int(os.getenv("HTTP_PORT", "8000"))
+WEBHOOK_BASE_URL    = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH        = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET      = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "100"))
+
+if BOT_MODE == "webhook" and not WEBHOOK_BASE_URL:
+    logging.error("BOT_MODE=webhook requires WEBHOOK_BASE_URL in .env")
+    exit(1)
+
+# Без секрета любой может прислать поддельный апдейт от имени админа
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    logging.error("BOT_MODE=webhook requires WEBHOOK_SECRET in .env")
+    exit(1)
+
 # Logging configuration
 logging.basicConfig(level=logging.INFO)
\ No newline at end of file
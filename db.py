@@ -1,19 +1,355 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
 import mysql.connector
-from config import DB_CFG
 
+import metrics
+from config import DB_CFG, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_PING_AFTER, DB_BATCH_SIZE
+
+
+class PoolTimeout(TimeoutError):
+    pass
+
+
+# Число обращений к MySQL за время жизни процесса (для bench.py и диагностики)
+_round_trips = 0
+
+
+def round_trips() -> int:
+    return _round_trips
+
+
+# ─── Соединение ───────────────────────────────────────────────────────────────
+class Connection:
+    """Обёртка над mysql.connector: каждый блокирующий вызов уходит в поток
+    пула (свой executor, не общий default), event loop при этом не стоит."""
+
+    def __init__(self, raw, executor: ThreadPoolExecutor):
+        self._raw = raw
+        self._executor = executor
+        self._job: Future | None = None
+        self.last_used = time.monotonic()
+
+    async def _run(self, fn, *args):
+        global _round_trips
+        _round_trips += 1
+        self._job = self._executor.submit(fn, *args)
+        return await asyncio.wrap_future(self._job)
+
+    def busy(self) -> bool:
+        """Поток ещё выполняет вызов — например, его ожидание отменили."""
+        return self._job is not None and not self._job.done()
+
+    async def wait_idle(self):
+        if self.busy():
+            await asyncio.wrap_future(self._job)
+
+    async def _query(self, sql: str, fn, *args):
+        name = metrics.query_name(sql)
+        started = time.perf_counter()
+        try:
+            return await self._run(fn, *args)
+        except Exception:
+            metrics.DB_ERRORS.inc(name)
+            raise
+        finally:
+            metrics.DB_SECONDS.observe(time.perf_counter() - started, name)
+
+    def _execute(self, sql, args, fetch):
+        cur = self._raw.cursor(buffered=True)
+        try:
+            cur.execute(sql, args)
+            if fetch == "one":
+                return cur.fetchone()
+            if fetch == "all":
+                return cur.fetchall()
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    def _executemany(self, sql, seq):
+        cur = self._raw.cursor()
+        try:
+            cur.executemany(sql, seq)
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    async def execute(self, sql: str, args=()) -> int:
+        return await self._query(sql, self._execute, sql, args, None)
+
+    async def executemany(self, sql: str, seq) -> int:
+        return await self._query(sql, self._executemany, sql, list(seq))
+
+    async def fetchone(self, sql: str, args=()):
+        return await self._query(sql, self._execute, sql, args, "one")
+
+    async def fetchall(self, sql: str, args=()) -> list:
+        return await self._query(sql, self._execute, sql, args, "all")
+
+    async def fetchall_dicts(self, sql: str, args=()) -> list[dict]:
+        def run():
+            cur = self._raw.cursor(buffered=True, dictionary=True)
+            try:
+                cur.execute(sql, args)
+                return cur.fetchall()
+            finally:
+                cur.close()
+        return await self._query(sql, run)
+
+    async def begin(self):
+        await self._run(self._raw.start_transaction)
+
+    async def commit(self):
+        await self._run(self._raw.commit)
+
+    async def rollback(self):
+        await self._run(self._raw.rollback)
+
+    async def ping(self) -> bool:
+        try:
+            await self._run(self._raw.ping, False)
+            return True
+        except mysql.connector.Error:
+            return False
+
+    def _close_quietly(self):
+        try:
+            self._raw.close()
+        except mysql.connector.Error:
+            pass
+
+    def is_connected(self) -> bool:
+        return self._raw.is_connected()
+
+    async def close(self):
+        if self.busy():
+            # Закрыть в том же потоке, когда отменённый вызов доработает
+            self._job.add_done_callback(lambda _: self._close_quietly())
+            return
+        try:
+            await self._run(self._raw.close)
+        except (mysql.connector.Error, RuntimeError):
+            pass  # RuntimeError — executor уже остановлен при закрытии пула
+
+
+# ─── Пул ──────────────────────────────────────────────────────────────────────
+class Pool:
+    def __init__(self, cfg: dict, minsize: int = 1, maxsize: int = 10,
+                 acquire_timeout: float = 5.0, ping_after: float = 30.0):
+        if minsize > maxsize:
+            raise ValueError("minsize > maxsize")
+        self._cfg = cfg
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.acquire_timeout = acquire_timeout
+        self.ping_after = ping_after
+        self._idle: list[Connection] = []
+        # Поток на соединение: в каждом соединении не больше одного вызова сразу
+        self._executor = ThreadPoolExecutor(maxsize, thread_name_prefix="db")
+        self._slots = asyncio.Semaphore(maxsize)
+        self._size = 0
+        self._closed = False
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def free(self) -> int:
+        return len(self._idle)
+
+    async def _connect(self) -> Connection:
+        # autocommit: одиночные SELECT не держат открытый снапшот между запросами,
+        # многошаговые операции явно открывают транзакцию через transaction()
+        raw = await asyncio.wrap_future(
+            self._executor.submit(lambda: mysql.connector.connect(autocommit=True, **self._cfg))
+        )
+        self._size += 1
+        return Connection(raw, self._executor)
+
+    async def _discard(self, conn: Connection):
+        self._size -= 1
+        await conn.close()
 
-def get_conn():
-    return mysql.connector.connect(**DB_CFG)
+    async def open(self):
+        while self._size < self.minsize:
+            self._idle.append(await self._connect())
+        logging.info("🟢 DB pool ready (min=%s, max=%s)", self.minsize, self.maxsize)
 
+    async def close(self):
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            await self._discard(conn)
+        self._executor.shutdown(wait=False)
 
-def save_language(user_id: int, lang: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO users (user_id, language) VALUES (%s, %s) "
-        "ON DUPLICATE KEY UPDATE language = %s",
-        (user_id, lang, lang)
+    async def _checkout(self) -> Connection:
+        while self._idle:
+            conn = self._idle.pop()
+            # Health-check только для давно простаивающих соединений
+            if time.monotonic() - conn.last_used < self.ping_after or await conn.ping():
+                return conn
+            logging.warning("⚠️ Dropping dead DB connection")
+            await self._discard(conn)
+        return await self._connect()
+
+    async def _checkin(self, conn: Connection, broken: bool):
+        if broken or self._closed or not conn.is_connected():
+            await self._discard(conn)
+            return
+        conn.last_used = time.monotonic()
+        self._idle.append(conn)
+
+    @asynccontextmanager
+    async def acquire(self):
+        if self._closed:
+            raise RuntimeError("DB pool is closed")
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"No DB connection available within {self.acquire_timeout}s") from None
+
+        conn = None
+        broken = False
+        try:
+            conn = await self._checkout()
+            yield conn
+        except BaseException:
+            broken = True
+            if conn is not None and conn.busy():
+                # Ожидание запроса отменили, а поток ещё работает с соединением:
+                # не трогаем его вторым потоком — дожидаемся и закрываем
+                try:
+                    await conn.wait_idle()
+                except (Exception, asyncio.CancelledError):
+                    pass
+            elif conn is not None:
+                try:
+                    await conn.rollback()
+                    broken = False
+                except Exception:
+                    pass
+            raise
+        finally:
+            if conn is not None:
+                await self._checkin(conn, broken)
+            self._slots.release()
+
+
+_pool: Pool | None = None
+
+
+def get_pool() -> Pool:
+    global _pool
+    if _pool is None:
+        _pool = Pool(DB_CFG, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_PING_AFTER)
+    return _pool
+
+
+async def init_pool() -> Pool:
+    pool = get_pool()
+    await pool.open()
+    return pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def acquire():
+    return get_pool().acquire()
+
+
+@asynccontextmanager
+async def transaction():
+    async with acquire() as conn:
+        await conn.begin()
+        yield conn
+        await conn.commit()
+
+
+# ─── Короткие хелперы для одиночных запросов ─────────────────────────────────
+async def fetchone(sql: str, args=()):
+    async with acquire() as conn:
+        return await conn.fetchone(sql, args)
+
+
+async def fetchall(sql: str, args=()) -> list:
+    async with acquire() as conn:
+        return await conn.fetchall(sql, args)
+
+
+async def execute(sql: str, args=()) -> int:
+    async with acquire() as conn:
+        return await conn.execute(sql, args)
+
+
+async def has_column(conn: Connection, table: str, column: str) -> bool:
+    row = await conn.fetchone(
+        "SELECT COUNT(*) FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+        (table, column)
+    )
+    return row[0] > 0
+
+
+async def has_index(conn: Connection, table: str, index: str) -> bool:
+    row = await conn.fetchone(
+        "SELECT COUNT(*) FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s",
+        (table, index)
     )
-    conn.commit()
-    cur.close()
-    conn.close()
+    return row[0] > 0
+
+
+async def iter_keyset(sql: str, args=(), *, start_after: int = 0,
+                      batch_size: int = DB_BATCH_SIZE, prefetch: int = 1):
+    """Стримит результат запроса пачками по keyset-курсору.
+
+    sql должен заканчиваться на "... AND <key> > %s ORDER BY <key> LIMIT %s",
+    ключ — первая колонка. Следующая пачка читается в фоне, пока
+    потребитель обрабатывает текущую, в памяти не больше prefetch+1 пачек.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=prefetch)
+
+    async def producer():
+        after = start_after
+        try:
+            while True:
+                rows = await fetchall(sql, (*args, after, batch_size))
+                if rows:
+                    await queue.put(rows)
+                if len(rows) < batch_size:
+                    break
+                after = rows[-1][0]
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+
+    task = asyncio.create_task(producer())
+    try:
+        while (batch := await queue.get()) is not None:
+            if isinstance(batch, Exception):
+                raise batch
+            for row in batch:
+                yield row
+    finally:
+        task.cancel()
+
+
+async def save_language(user_id: int, lang: str):
+    async with acquire() as conn:
+        await conn.execute(
+            "INSERT INTO users (user_id, language) VALUES (%s, %s) "
+            "ON DUPLICATE KEY UPDATE language = %s",
+            (user_id, lang, lang)
+        )
+        # Пользователь снова пишет боту — снимаем отметку о блокировке
+        await conn.execute("DELETE FROM blocked_users WHERE user_id=%s", (user_id,))
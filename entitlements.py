@@ -0,0 +1,117 @@
+"""Денормализованный срок доступа users.active_until.
+
+active_until = MAX(expire_at) по ACTIVE-подпискам пользователя (NULL — подписок нет).
+Поле обновляется в той же транзакции, что и subscriptions (handle_ipn, on_buy),
+поэтому проверка доступа — чтение одной строки users по первичному ключу.
+
+Разовая миграция / сверка существующих данных:
+    python entitlements.py backfill
+    python entitlements.py check
+"""
+import argparse
+import asyncio
+import logging
+import sys
+
+import db
+import migrations
+from config import DB_BATCH_SIZE
+
+REFRESH_SQL = """
+    UPDATE users
+       SET active_until = (
+               SELECT MAX(expire_at) FROM subscriptions
+                WHERE user_id = %s AND status = 'ACTIVE'
+           )
+     WHERE user_id = %s
+"""
+
+BACKFILL_SQL = """
+    UPDATE users u
+ LEFT JOIN (
+        SELECT user_id, MAX(expire_at) AS max_exp
+          FROM subscriptions
+         WHERE status = 'ACTIVE' AND user_id > %s AND user_id <= %s
+      GROUP BY user_id
+    ) s ON s.user_id = u.user_id
+       SET u.active_until = s.max_exp
+     WHERE u.user_id > %s AND u.user_id <= %s
+"""
+
+MISMATCH_SQL = """
+    SELECT u.user_id, u.active_until, s.max_exp
+      FROM users u
+ LEFT JOIN (
+        SELECT user_id, MAX(expire_at) AS max_exp
+          FROM subscriptions
+         WHERE status = 'ACTIVE'
+      GROUP BY user_id
+    ) s ON s.user_id = u.user_id
+     WHERE NOT (u.active_until <=> s.max_exp)  /* full-scan-ok */
+"""
+
+
+async def refresh_active_until(conn: db.Connection, user_id: int):
+    """Пересчитать active_until; вызывать внутри той же транзакции, что меняет subscriptions."""
+    await conn.execute(REFRESH_SQL, (user_id, user_id))
+
+
+async def refresh_active_until_many(conn: db.Connection, user_ids) -> int:
+    """То же для пачки пользователей одним запросом."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+    return await conn.execute(
+        "UPDATE users u SET u.active_until = ("
+        "  SELECT MAX(s.expire_at) FROM subscriptions s"
+        "   WHERE s.user_id = u.user_id AND s.status = 'ACTIVE'"
+        ") WHERE u.user_id IN (" + ", ".join(["%s"] * len(user_ids)) + ")",
+        user_ids
+    )
+
+
+# ─── Backfill и сверка ─────────────────────────────────────────────────────────
+async def backfill(batch_size: int = DB_BATCH_SIZE) -> int:
+    await migrations.upgrade()
+    after, batches = 0, 0
+    while True:
+        row = await db.fetchone(
+            "SELECT MAX(user_id), COUNT(*) FROM ("
+            "  SELECT user_id FROM users WHERE user_id > %s ORDER BY user_id LIMIT %s"
+            ") t",
+            (after, batch_size)
+        )
+        upto, count = row
+        if not count:
+            break
+        # Короткая транзакция на пачку — без длинных блокировок users
+        async with db.transaction() as conn:
+            await conn.execute(BACKFILL_SQL, (after, upto, after, upto))
+        after, batches = upto, batches + 1
+    logging.info("✅ active_until backfilled in %s batches", batches)
+    return batches
+
+
+async def check(limit: int = 20) -> list:
+    rows = await db.fetchall(MISMATCH_SQL + " LIMIT %s", (limit,))
+    for user_id, stored, expected in rows:
+        logging.warning("⚠️ user %s: active_until=%s, expected %s", user_id, stored, expected)
+    if not rows:
+        logging.info("✅ active_until is consistent with subscriptions")
+    return rows
+
+
+async def _main(command: str) -> int:
+    await db.init_pool()
+    try:
+        if command == "backfill":
+            await backfill()
+        return 1 if await check() else 0
+    finally:
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="users.active_until maintenance")
+    parser.add_argument("command", choices=["backfill", "check"])
+    sys.exit(asyncio.run(_main(parser.parse_args().command)))
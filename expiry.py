@@ -0,0 +1,200 @@
+"""Истечение подписок и предупреждения «осталось N дней».
+
+В памяти — куча событий на ближайшие EXPIRY_HORIZON секунд: момент
+истечения подписки (offset 0) и моменты предупреждений (expire_at - N дней).
+Куча пополняется окнами по индексу (status, expire_at): каждое окно читает
+только подписки, которые истекают в нём, так что работа пропорциональна
+числу истекающих подписок, а не размеру таблицы. Подписки, истёкшие до
+запуска, в кучу не попадают: их переводят в EXPIRED пачками по EXPIRY_BATCH_SIZE.
+
+Сработавшие события обрабатываются пачками: один UPDATE переводит подписки
+в EXPIRED и пересчитывает users.active_until, предупреждения уходят через
+Broadcaster. Продление или отмену, случившиеся после загрузки окна, учитывают
+условия в самих запросах — устаревшее событие просто ничего не меняет.
+"""
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+
+import db
+import metrics
+from broadcast import Broadcaster
+from config import EXPIRY_HORIZON, EXPIRY_BATCH_SIZE, EXPIRY_NOTICE_DAYS
+from entitlements import refresh_active_until_many
+from keyboards import buy_kb
+from locale_utils import t
+from user_context import invalidate
+
+WINDOW_SQL = """
+    SELECT subscription_id, user_id, expire_at FROM subscriptions
+     WHERE status = 'ACTIVE' AND expire_at > %s AND expire_at <= %s
+"""
+
+OVERDUE_SQL = """
+    SELECT subscription_id, user_id, expire_at FROM subscriptions
+     WHERE status = 'ACTIVE' AND expire_at <= NOW()
+  ORDER BY expire_at
+     LIMIT %s
+"""
+
+EXPIRED   = metrics.Counter("bot_subscriptions_expired_total", "Subscriptions moved to EXPIRED")
+NOTICES   = metrics.Counter("bot_expiry_notices_total", "Expiry notices queued", ("days",))
+HEAP_SIZE = metrics.Gauge("bot_expiry_heap_size", "Expiry events waiting in memory")
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _in(values) -> str:
+    return ", ".join(["%s"] * len(values))
+
+
+class ExpirySweeper:
+    def __init__(self, bot: Bot, horizon: float = EXPIRY_HORIZON,
+                 batch_size: int = EXPIRY_BATCH_SIZE, notice_days: tuple[int, ...] = EXPIRY_NOTICE_DAYS):
+        self.bot = bot
+        self.horizon = timedelta(seconds=horizon)
+        self.batch_size = batch_size
+        self.offsets = (0, *sorted(set(notice_days)))
+        # (момент срабатывания, дней до истечения, subscription_id, user_id, expire_at)
+        self._heap: list[tuple[datetime, int, str, int, datetime]] = []
+        self._loaded: dict[int, datetime] = {}
+        self._next_refill = EPOCH
+        self._skew = timedelta(0)
+        self._task: asyncio.Task | None = None
+
+    def _now(self) -> datetime:
+        # Время БД: expire_at хранится в часовом поясе MySQL
+        return datetime.now() + self._skew
+
+    async def _sync_clock(self):
+        row = await db.fetchone("SELECT NOW()")
+        self._skew = row[0] - datetime.now()
+
+    async def _expire_overdue(self):
+        """Истёкшие до запуска подписки — пачками, без загрузки в кучу."""
+        while True:
+            rows = await db.fetchall(OVERDUE_SQL, (self.batch_size,))
+            if rows:
+                await self._expire([(expire_at, 0, sub_id, user_id, expire_at)
+                                    for sub_id, user_id, expire_at in rows])
+            if len(rows) < self.batch_size:
+                return
+            await asyncio.sleep(0)
+
+    async def _refill(self, now: datetime):
+        if 0 not in self._loaded:
+            await self._expire_overdue()
+        for days in self.offsets:
+            offset = timedelta(days=days)
+            # Пропущенные до запуска предупреждения не досылаем
+            lower = self._loaded.get(days, now + offset)
+            upper = now + self.horizon + offset
+            rows = await db.fetchall(WINDOW_SQL, (lower, upper))
+            for sub_id, user_id, expire_at in rows:
+                heapq.heappush(self._heap, (expire_at - offset, days, sub_id, user_id, expire_at))
+            self._loaded[days] = upper
+        self._next_refill = now + self.horizon / 2
+        HEAP_SIZE.set(len(self._heap))
+
+    async def _expire(self, events: list[tuple]):
+        ids = [sub_id for _, _, sub_id, _, _ in events]
+        users = sorted({user_id for _, _, _, user_id, _ in events})
+        async with db.transaction() as conn:
+            changed = await conn.execute(
+                "UPDATE subscriptions SET status = 'EXPIRED', updated_at = NOW() "
+                f"WHERE subscription_id IN ({_in(ids)}) AND status = 'ACTIVE' AND expire_at <= NOW()",
+                ids
+            )
+            await refresh_active_until_many(conn, users)
+        for user_id in users:
+            invalidate(user_id)
+        EXPIRED.inc(value=changed)
+        if changed:
+            logging.info("⌛ Expired %s subscriptions", changed)
+
+    async def _notify(self, events: list[tuple]):
+        # subscription_id -> (дней до истечения, expire_at на момент загрузки окна)
+        events_by_sub = {sub_id: (days, expire_at) for _, days, sub_id, _, expire_at in events}
+        ids = list(events_by_sub)
+        # Только если это последняя подписка пользователя и её не продлили
+        rows = await db.fetchall(
+            "SELECT s.user_id, u.language, s.subscription_id, s.expire_at "
+            "  FROM subscriptions s JOIN users u ON u.user_id = s.user_id "
+            f" WHERE s.subscription_id IN ({_in(ids)}) AND s.status = 'ACTIVE' "
+            "   AND u.active_until = s.expire_at "
+            " ORDER BY s.user_id",
+            ids
+        )
+        recipients, seen = [], set()
+        for user_id, lang, sub_id, expire_at in rows:
+            days, loaded_expire_at = events_by_sub[sub_id]
+            if expire_at != loaded_expire_at:
+                continue  # продлена на месте после загрузки окна — событие устарело
+            if user_id not in seen:
+                seen.add(user_id)
+                recipients.append((user_id, lang, days, expire_at))
+                NOTICES.inc(str(days))
+        if not recipients:
+            return
+
+        def build(user_id: int, lang: str, days: int, expire_at: datetime) -> dict:
+            return {
+                "text": t(lang, "expiry_notice", days=days, date=expire_at.strftime("%d.%m.%Y")),
+                "reply_markup": buy_kb(lang),
+            }
+
+        await Broadcaster(self.bot).run("expiry_notice", recipients, build, resume=False)
+
+    async def _fire(self, due: list[tuple]):
+        expired = [e for e in due if e[1] == 0]
+        notices = [e for e in due if e[1] != 0]
+        if expired:
+            await self._expire(expired)
+        if notices:
+            await self._notify(notices)
+
+    async def run_once(self):
+        now = self._now()
+        if now >= self._next_refill:
+            await self._sync_clock()
+            now = self._now()
+            await self._refill(now)
+        while self._heap and self._heap[0][0] <= now:
+            due = []
+            while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                due.append(heapq.heappop(self._heap))
+            HEAP_SIZE.set(len(self._heap))
+            try:
+                await self._fire(due)
+            except Exception:
+                for event in due:  # повторим на следующем проходе
+                    heapq.heappush(self._heap, event)
+                raise
+
+    def _sleep_for(self) -> float:
+        wake = self._next_refill
+        if self._heap:
+            wake = min(wake, self._heap[0][0])
+        return min(max((wake - self._now()).total_seconds(), 1.0), self.horizon.total_seconds())
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+                delay = self._sleep_for()
+            except Exception:
+                logging.exception("❌ Expiry sweep failed")
+                delay = 30.0
+            await asyncio.sleep(delay)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+        logging.info("🟢 Expiry sweeper started (notices: %s days)", ", ".join(map(str, self.offsets[1:])) or "off")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
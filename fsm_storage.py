@@ -0,0 +1,87 @@
+"""FSM-хранилище aiogram в MySQL (таблица fsm_state).
+
+Состояние регистрации и вопроса в поддержку переживает рестарт и доступно
+любому процессу. Чтения идут из LRU-кэша процесса: запись сквозная, а в
+режиме с несколькими воркерами пользователь всегда попадает в один и тот же
+процесс (см. shard.py), поэтому кэш не расходится с таблицей.
+Пустые записи (нет состояния и данных) удаляются, таблица не растёт.
+"""
+import json
+from collections import OrderedDict
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import db
+from config import FSM_CACHE_MAX
+
+UPSERT_SQL = """
+    INSERT INTO fsm_state (bot_id, chat_id, user_id, thread_id, destiny, state, data, updated_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+    ON DUPLICATE KEY UPDATE state = VALUES(state), data = VALUES(data), updated_at = NOW()
+"""
+DELETE_SQL = """
+    DELETE FROM fsm_state
+     WHERE bot_id = %s AND chat_id = %s AND user_id = %s AND thread_id = %s AND destiny = %s
+"""
+SELECT_SQL = """
+    SELECT state, data FROM fsm_state
+     WHERE bot_id = %s AND chat_id = %s AND user_id = %s AND thread_id = %s AND destiny = %s
+"""
+
+Key = tuple[int, int, int, int, str]
+
+
+def _key(key: StorageKey) -> Key:
+    return key.bot_id, key.chat_id, key.user_id, key.thread_id or 0, key.destiny
+
+
+class MySQLStorage(BaseStorage):
+    def __init__(self, cache_size: int = FSM_CACHE_MAX):
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Key, tuple[str | None, dict]]" = OrderedDict()
+
+    def _remember(self, key: Key, record: tuple[str | None, dict]):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: Key) -> tuple[str | None, dict]:
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            return record
+        row = await db.fetchone(SELECT_SQL, key)
+        record = (row[0], json.loads(row[1]) if row[1] else {}) if row else (None, {})
+        self._remember(key, record)
+        return record
+
+    async def _save(self, key: Key, state: str | None, data: dict):
+        if self._cache.get(key) == (state, data):
+            return  # state.clear() на пустом состоянии и т.п. — в БД писать нечего
+        if state is None and not data:
+            await db.execute(DELETE_SQL, key)
+        else:
+            await db.execute(UPSERT_SQL, (*key, state, json.dumps(data, ensure_ascii=False)))
+        self._remember(key, (state, data))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = _key(key)
+        _, data = await self._load(k)
+        await self._save(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._load(_key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        k = _key(key)
+        state, _ = await self._load(k)
+        await self._save(k, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return dict((await self._load(_key(key)))[1])
+
+    async def close(self) -> None:
+        self._cache.clear()
@@ -8,17 +8,26 @@ from aiogram import types, F, Dispatcher
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import (
-    InlineKeyboardButton, InlineKeyboardMarkup,
-    ReplyKeyboardMarkup, KeyboardButton
-)
 
-from db import get_conn, save_language
-from locale_utils import load_messages
-from payments import create_email_subscription, fetch_subscription_invoices, SUBSCRIPTION_PLANS
+import db
+from user_writes import user_writes
+from locale_utils import load_messages, t
+from payments import SUBSCRIPTION_PLANS
+from checkout import checkout, CheckoutError
 from aiogram import Bot
 from remind import remind_unpaid_users
-from keyboards import buy_kb
+from keyboards import (
+    buy_kb, language_kb, reset_kb, main_menu_kb,
+    SUPPORT_BUTTON, HISTORY_BUTTON, NEWS_BUTTON,
+)
+from signal_feed import feed, paginate, FEED_PREFIX, FULL_FEED_KB
+from archive import archive_signals
+from signal_delivery import cursors, pending_pages, schedule_push, MAX_DELTA_MESSAGES
+from user_context import UserContext, UserContextMiddleware, load_context, invalidate
+from metrics import HandlerMetricsMiddleware
+from profiler import profiler, ProfilingMiddleware
+from backpressure import BackpressureMiddleware
+from reconcile import reconcile
 
 
 bot = None
@@ -32,41 +41,6 @@ class Form(StatesGroup):
     support = State()
 
 
-# ─── Keyboards ─────────────────────────────────────────────────────────────────
-def language_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[[
-        InlineKeyboardButton(text="English", callback_data="lang:en"),
-        InlineKeyboardButton(text="Русский", callback_data="lang:ru"),
-    ]])
-
-def reset_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Reset", callback_data="action:reset")]
-    ])
-
-def main_menu_kb(lang: str) -> ReplyKeyboardMarkup:
-    msgs = load_messages(lang)
-    return ReplyKeyboardMarkup(
-        keyboard=[[ 
-            KeyboardButton(text=msgs["signals_button"]),
-            KeyboardButton(text=msgs["commands_button"]),
-            KeyboardButton(text="📩 Техподдержка"),
-            KeyboardButton(text="🕓 История сигналов"),
-            KeyboardButton(text="📰 Новости") 
-        ]],
-        resize_keyboard=True
-    )
-
-# ─── Утилита ────────────────────────────────────────────────────────────────────
-async def get_user_lang(user_id: int) -> str:
-    conn = get_conn()
-    cur  = conn.cursor()
-    cur.execute("SELECT language FROM users WHERE user_id=%s", (user_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    return row[0] if row else "en"
-
 # ─── Хэндлеры ──────────────────────────────────────────────────────────────────
 async def cmd_start(msg: types.Message, state: FSMContext):
     await state.clear()
@@ -79,7 +53,8 @@ async def cmd_start(msg: types.Message, state: FSMContext):
 async def on_lang(cb: types.CallbackQuery, state: FSMContext):
     lang = cb.data.split(":", 1)[1]
     uid  = cb.from_user.id
-    save_language(uid, lang)
+    await user_writes.set_language(uid, lang)
+    invalidate(uid)
     await state.update_data(lang=lang)
 
     msgs = load_messages(lang)
@@ -102,31 +77,19 @@ async def process_email(msg: types.Message, state: FSMContext):
     username = data["username"]
     email    = msg.text.strip()
 
-    conn = get_conn()
-    cur  = conn.cursor()
-    cur.execute(
-        "UPDATE users SET username=%s, email=%s WHERE user_id=%s",
-        (username, email, uid)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    await user_writes.set_contact(uid, username, email)
+    invalidate(uid)
 
-    msgs = load_messages(lang)
     await msg.answer(
-        text=msgs["registration_success"].format(username=username, email=email),
+        text=t(lang, "registration_success", username=username, email=email),
         reply_markup=main_menu_kb(lang)
     )
     await state.clear()
 
 async def on_reset(cb: types.CallbackQuery, state: FSMContext):
     uid  = cb.from_user.id
-    conn = get_conn()
-    cur  = conn.cursor()
-    cur.execute("DELETE FROM users WHERE user_id=%s", (uid,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    await user_writes.delete(uid)
+    invalidate(uid)
 
     await state.clear()
     await cb.message.edit_text(
@@ -136,105 +99,78 @@ async def on_reset(cb: types.CallbackQuery, state: FSMContext):
     await state.set_state(Form.lang)
     await cb.answer()
 
-async def show_signals(msg: types.Message):
-    uid  = msg.from_user.id
-    lang = await get_user_lang(uid)
-    msgs = load_messages(lang)
+async def show_signals(msg: types.Message, ctx: UserContext):
+    lang = ctx.language
 
-    conn = get_conn(); cur = conn.cursor()
     try:
-        # Проверка активной подписки
-        cur.execute("""
-            SELECT status, expire_at
-              FROM subscriptions
-             WHERE user_id=%s AND status='ACTIVE' AND expire_at > NOW()
-          ORDER BY created_at DESC
-             LIMIT 1
-        """, (uid,))
-        row = cur.fetchone()
-
-        if not row:
-            await msg.answer(text=msgs["pay_prompt"], reply_markup=buy_kb(lang))
+        if not ctx.has_access:
+            await msg.answer(text=load_messages(lang)["pay_prompt"], reply_markup=buy_kb(lang))
             return
 
-        # Если подписка активна — выводим сигналы
-        cur.execute("SELECT text FROM signals ORDER BY created_at DESC")
-        signals = cur.fetchall()
+        # Если подписка активна — только новые с прошлого раза сигналы
+        pages = await pending_pages(ctx.user_id)
 
-        if not signals:
-            await msg.answer("📭 Сигналов пока нет.")
+        if not pages:
+            await msg.answer("📭 Новых сигналов нет.", reply_markup=FULL_FEED_KB)
             return
 
-        text = "\n\n".join(f"📌 {row[0]}" for row in signals)
-        await msg.answer(text=text)
+        for text, upto in pages[:MAX_DELTA_MESSAGES]:
+            await msg.answer(text=text)
+            cursors.advance(ctx.user_id, upto)
+
+        if len(pages) > MAX_DELTA_MESSAGES:
+            await msg.answer("📜 Более ранние сигналы — в полной ленте.", reply_markup=FULL_FEED_KB)
 
     except Exception as e:
         logging.error(f"❌ Ошибка при выводе сигналов: {e}")
         await msg.answer("⚠️ Произошла ошибка. Попробуйте позже.")
-    finally:
-        cur.close(); conn.close()
-
 
-async def on_buy(cb: types.CallbackQuery):
-    from payments import SUBSCRIPTION_PLANS
 
+async def on_buy(cb: types.CallbackQuery, ctx: UserContext):
     uid = cb.from_user.id
     plan_key = cb.data.split(":", 1)[1]
-    await cb.answer("⏳ Формирую подписку…")
 
     plan = SUBSCRIPTION_PLANS.get(plan_key)
     if not plan:
+        await cb.answer()
         await cb.message.answer("❌ Неверный план подписки.")
         return
 
-    plan_id = plan["id"]
-
-    # Получаем email пользователя
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT email FROM users WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    cur.close(); conn.close()
-
-    if not row:
+    # Email пользователя уже загружен в контекст апдейта
+    if not ctx.email:
+        await cb.answer()
         await cb.message.answer("❌ Email не найден. Сначала зарегистрируйтесь командой /start.")
         return
 
-    email = row[0]
+    # Повторное нажатие: счёт уже выставлен или ещё ждём его
+    pending = checkout.cached(ctx, plan_key)
+    if pending:
+        await cb.answer()
+        if pending.url:
+            await cb.message.answer(f"🔗 Оплатите подписку по ссылке:\n{pending.url}")
+        else:
+            await cb.message.answer("⏳ Счёт ещё готовится — ссылка придёт сообщением.")
+        return
+    if checkout.in_flight(uid, plan_key):
+        # Ссылку пришлёт первое нажатие
+        await cb.answer("⏳ Уже формирую подписку…")
+        return
 
-    # Создаём подписку
+    await cb.answer("⏳ Формирую подписку…")
     try:
-        sub = await create_email_subscription(email, plan_id)
+        pending = await checkout.start(bot, ctx, plan_key, plan)
     except httpx.HTTPStatusError as e:
         logging.error("NOWPayments /subscriptions error %s: %s", e.response.status_code, e.response.text)
         await cb.message.answer("❌ Не удалось оформить подписку: " + e.response.json().get("message", ""))
         return
-
-    sub_id = sub.get("id")
-    if not sub_id:
-        await cb.message.answer("❌ Не удалось получить ID подписки.")
+    except CheckoutError as e:
+        await cb.message.answer(str(e))
         return
 
-    logging.info(f"🔖 Subscription ID: {sub_id}")
-
-    # Сохраняем в БД
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO subscriptions(subscription_id, user_id, plan_id, email, status, expire_at, created_at, updated_at)
-        VALUES (%s, %s, %s, %s, 'WAITING_PAY', DATE_ADD(NOW(), INTERVAL 30 DAY), NOW(), NOW())
-        ON DUPLICATE KEY UPDATE
-            status = 'WAITING_PAY',
-            expire_at = DATE_ADD(NOW(), INTERVAL 30 DAY),
-            updated_at = NOW()
-    """, (sub_id, uid, plan_id, email))
-    conn.commit(); cur.close(); conn.close()
-
-    # Получаем ссылку на оплату
-    invs = await fetch_subscription_invoices(sub_id)
-    if invs:
-        url = invs[0].get("invoice_url")
-        await cb.message.answer(f"🔗 Оплатите подписку по ссылке:\n{url}")
+    if pending.url:
+        await cb.message.answer(f"🔗 Оплатите подписку по ссылке:\n{pending.url}")
     else:
-        await cb.message.answer("✅ Подписка создана, но счёт пока не готов. Попробуйте позже.")
+        await cb.message.answer("⏳ Подписка создана, счёт готовится — ссылка придёт сообщением.")
 
 async def admin_login(msg: types.Message):
     password = msg.text.split(maxsplit=1)[1] if len(msg.text.split()) > 1 else ""
@@ -242,88 +178,89 @@ async def admin_login(msg: types.Message):
         return await msg.answer("❌ Неверный пароль.")
 
     uid = msg.from_user.id
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("REPLACE INTO admins(user_id, is_authorized) VALUES (%s, TRUE)", (uid,))
-    conn.commit(); cur.close(); conn.close()
+    await db.execute("REPLACE INTO admins(user_id, is_authorized) VALUES (%s, TRUE)", (uid,))
+    invalidate(uid)
 
     await msg.answer("✅ Вы авторизованы как администратор.")
 
-async def add_signal(msg: types.Message):
-    uid = msg.from_user.id
+async def add_signal(msg: types.Message, ctx: UserContext):
     text = msg.text.removeprefix("/add_signal").strip()
 
     if not text:
         return await msg.answer("❗ Укажите текст сигнала.")
 
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT is_authorized FROM admins WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if not row or not row[0]:
+    if not ctx.is_admin:
         return await msg.answer("⛔ Нет доступа.")
 
-    cur.execute("INSERT INTO signals(text) VALUES (%s)", (text,))
-    conn.commit(); cur.close(); conn.close()
+    await db.execute("INSERT INTO signals(text) VALUES (%s)", (text,))
+    feed.invalidate()
 
-    await msg.answer("✅ Сигнал добавлен.")
+    status = await msg.answer("✅ Сигнал добавлен. Запускаю рассылку…")
+    schedule_push(bot, report_to=(status.chat.id, status.message_id))
 
-async def clear_signals(msg: types.Message):
-    uid = msg.from_user.id
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT is_authorized FROM admins WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if not row or not row[0]:
+async def clear_signals(msg: types.Message, ctx: UserContext):
+    if not ctx.is_admin:
         return await msg.answer("⛔ Нет доступа.")
 
-    cur.execute("DELETE FROM signals")
-    conn.commit(); cur.close(); conn.close()
-    await msg.answer("🗑 Все сигналы удалены.")
+    # Сигналы не удаляются, а пачками переносятся в историю
+    moved = await archive_signals()
+    feed.invalidate()
+    left = (await db.fetchone("SELECT COUNT(*) FROM signals"))[0]
+    if left:
+        return await msg.answer(f"⚠️ Перенесено в историю: {moved}, в ленте осталось сигналов: {left}.")
+    await msg.answer(f"🗑 Все сигналы убраны из ленты ({moved} перенесено в историю).")
 
-async def show_admin_signals(msg: types.Message):
-    uid = msg.from_user.id
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT is_authorized FROM admins WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if not row or not row[0]:
+async def show_admin_signals(msg: types.Message, ctx: UserContext):
+    if not ctx.is_admin:
         return await msg.answer("⛔ Нет доступа.")
 
-    cur.execute("SELECT text FROM signals ORDER BY created_at DESC")
-    signals = cur.fetchall(); cur.close(); conn.close()
+    text, kb = await feed.page(0)
 
-    if not signals:
+    if not text:
         return await msg.answer("📭 Сигналов нет.")
-    
-    text = "\n\n".join(f"📌 {row[0]}" for row in signals)
-    await msg.answer(text)
 
+    await msg.answer(text, reply_markup=kb)
 
-async def logout_admin(msg: types.Message):
-    uid = msg.from_user.id
 
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT is_authorized FROM admins WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
+async def on_feed_page(cb: types.CallbackQuery, ctx: UserContext):
+    value = cb.data.removeprefix(FEED_PREFIX)
+    if value == "noop":
+        return await cb.answer()
+    if not (ctx.has_access or ctx.is_admin):
+        return await cb.answer("⛔ Нет доступа.", show_alert=True)
+
+    if not value.isdigit():
+        return await cb.answer()  # испорченные или подделанные callback data
+
+    text, kb = await feed.page(int(value))
+    if not text:
+        await cb.answer("📭 Сигналов пока нет.")
+        return
+    if text != cb.message.text:
+        await cb.message.edit_text(text=text, reply_markup=kb)
+    await cb.answer()
+
 
-    if not row or not row[0]:
+async def logout_admin(msg: types.Message, ctx: UserContext):
+    uid = msg.from_user.id
+
+    if not ctx.is_admin:
         await msg.answer("ℹ️ Вы не авторизованы как администратор.")
     else:
-        cur.execute("DELETE FROM admins WHERE user_id=%s", (uid,))
-        conn.commit()
-        lang = await get_user_lang(uid)
+        await db.execute("DELETE FROM admins WHERE user_id=%s", (uid,))
+        invalidate(uid)
         await msg.answer(
             "🔒 Вы вышли из режима администратора.",
-            reply_markup=main_menu_kb(lang)
+            reply_markup=main_menu_kb(ctx.language)
         )
 
-    cur.close(); conn.close()
-
 async def start_support(msg: types.Message, state: FSMContext):
     await msg.answer("✍️ Напишите ваш вопрос, и администратор ответит вам.")
     await state.set_state(Form.support)
 
-async def handle_support_question(msg: types.Message, state: FSMContext):
+async def handle_support_question(msg: types.Message, state: FSMContext, ctx: UserContext):
     await state.clear()
-    user_id = msg.from_user.id
-    lang = await get_user_lang(user_id)  # Получаем язык пользователя
+    lang = ctx.language  # Язык пользователя из контекста апдейта
     admin_id = int(os.getenv("ADMIN_TELEGRAM_ID"))
 
     await msg.answer(
@@ -337,16 +274,10 @@ async def handle_support_question(msg: types.Message, state: FSMContext):
     )
 
 
-async def reply_to_user(msg: types.Message):
-    uid = msg.from_user.id
-
+async def reply_to_user(msg: types.Message, ctx: UserContext):
     # Проверка авторизации
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT is_authorized FROM admins WHERE user_id=%s", (uid,))
-    row = cur.fetchone()
-    if not row or not row[0]:
+    if not ctx.is_admin:
         await msg.answer("⛔ У вас нет доступа.")
-        cur.close(); conn.close()
         return
 
     # Проверка формата команды
@@ -364,72 +295,94 @@ async def reply_to_user(msg: types.Message):
     except Exception as e:
         logging.error(f"Ошибка отправки ответа: {e}")
         await msg.answer("❌ Не удалось отправить сообщение.")
-    finally:
-        cur.close(); conn.close()
 
 async def show_history(msg: types.Message):
-    uid = msg.from_user.id
-    lang = await get_user_lang(uid)
-    msgs = load_messages(lang)
-
-    conn = get_conn(); cur = conn.cursor()
     try:
-        cur.execute("SELECT text FROM signal_history ORDER BY created_at DESC LIMIT 100")
-        signals = cur.fetchall()
+        signals = await db.fetchall("SELECT text FROM signal_history ORDER BY created_at DESC LIMIT 100")
 
         if not signals:
             await msg.answer("📭 История сигналов пуста.")
             return
 
-        text = "\n\n".join(f"📌 {row[0]}" for row in signals)
+        text = paginate(row[0] for row in signals)[0]
         await msg.answer(text=text)
 
     except Exception as e:
         logging.error(f"❌ Ошибка при выводе истории: {e}")
         await msg.answer("⚠️ Произошла ошибка. Попробуйте позже.")
-    finally:
-        cur.close(); conn.close()
 
 async def show_news(msg: types.Message):
     await msg.answer("👉 Для просмотра текущих новостей перейдите: https://t.me/your_channel_name")
 
     from remind import remind_unpaid_users
 
-async def manual_remind(msg: types.Message):
-    uid = msg.from_user.id
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT is_authorized FROM admins WHERE user_id=%s", (uid,))
-    row = cur.fetchone(); cur.close(); conn.close()
+async def manual_remind(msg: types.Message, ctx: UserContext):
+    if not ctx.is_admin:
+        return await msg.answer("⛔ Нет доступа.")
+
+    await msg.answer("⏳ Рассылка напоминаний запущена…")
+    stats = await remind_unpaid_users(bot)
+    await msg.answer("📣 Напоминания отправлены.\n" + stats.summary())
+
+
 
-    if not row or not row[0]:
+async def manual_reconcile(msg: types.Message, ctx: UserContext):
+    if not ctx.is_admin:
         return await msg.answer("⛔ Нет доступа.")
 
-    await remind_unpaid_users(bot)
-    await msg.answer("📣 Напоминания отправлены.")
+    await msg.answer("⏳ Сверка подписок с NOWPayments запущена…")
+    report = await reconcile(bot)
+    await msg.answer("🧾 " + report.summary())
 
 
+async def profile_cmd(msg: types.Message, ctx: UserContext):
+    if not ctx.is_admin:
+        return await msg.answer("⛔ Нет доступа.")
+
+    # /profile — выгрузить, /profile rate 0.01 — сменить долю, /profile reset — обнулить
+    args = msg.text.split()[1:]
+    if args[:1] == ["rate"] and len(args) == 2:
+        try:
+            profiler.rate = min(max(float(args[1]), 0.0), 1.0)
+        except ValueError:
+            return await msg.answer("⚠️ Используй формат: /profile rate 0.01")
+        return await msg.answer("🔥 Профилирование: " + profiler.summary())
+    if args[:1] == ["reset"]:
+        profiler.reset()
+        return await msg.answer("🔥 Профиль очищен.")
+
+    if not profiler.stacks:
+        return await msg.answer("📭 Профиль пуст: " + profiler.summary())
+    path = profiler.dump()
+    await msg.answer_document(types.FSInputFile(path), caption="🔥 " + profiler.summary())
 
-async def show_commands(msg: types.Message):
-    lang = await get_user_lang(msg.from_user.id)
-    await msg.answer(text=load_messages(lang)["commands_list"])
+
+async def show_commands(msg: types.Message, ctx: UserContext):
+    await msg.answer(text=load_messages(ctx.language)["commands_list"])
 
 async def restore_menu_if_registered(msg: types.Message, state: FSMContext):
     if await state.get_state() is not None:
         return  # если пользователь в процессе ввода — не трогаем
-    user_id = msg.from_user.id
-
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT EXISTS(SELECT 1 FROM users WHERE user_id=%s)", (user_id,))
-    exists = cur.fetchone()[0]
-    cur.close(); conn.close()
 
-    if exists:
-        lang = await get_user_lang(user_id)
-        await msg.answer("🔄 Меню восстановлено", reply_markup=main_menu_kb(lang))
+    ctx = await load_context(msg.from_user.id)
+    if ctx.registered:
+        await msg.answer("🔄 Меню восстановлено", reply_markup=main_menu_kb(ctx.language))
 
 
 # ─── Регистрация хэндлеров ─────────────────────────────────────────────────────
 def register_handlers(dp: Dispatcher, external_bot: Bot):
+    # Лишние апдейты к тяжёлым хэндлерам отбрасываются раньше всего остального
+    guarded = (show_signals, show_history, on_buy, on_feed_page, restore_menu_if_registered)
+    dp.message.middleware(BackpressureMiddleware("message", guarded))
+    dp.callback_query.middleware(BackpressureMiddleware("callback_query", guarded))
+    # Затем метрики: в латентность хэндлера входит загрузка контекста
+    dp.message.middleware(HandlerMetricsMiddleware("message"))
+    dp.callback_query.middleware(HandlerMetricsMiddleware("callback_query"))
+    dp.message.middleware(ProfilingMiddleware("message"))
+    dp.callback_query.middleware(ProfilingMiddleware("callback_query"))
+    dp.message.middleware(UserContextMiddleware())
+    dp.callback_query.middleware(UserContextMiddleware())
+
     dp.message.register(cmd_start,        Command("start"))
     dp.callback_query.register(on_lang,   Form.lang, lambda c: c.data.startswith("lang:"))
     dp.message.register(process_username, Form.username)
@@ -443,14 +396,17 @@ def register_handlers(dp: Dispatcher, external_bot: Bot):
     dp.message.register(add_signal, Command("add_signal"))
     dp.message.register(clear_signals, Command("clear_signals"))
     dp.message.register(show_admin_signals, Command("show_signals_admin"))
+    dp.callback_query.register(on_feed_page, F.data.startswith(FEED_PREFIX))
     dp.message.register(admin_login, Command("admin_login"))
     dp.message.register(logout_admin, Command("logout_admin"))
-    dp.message.register(start_support, F.text == "📩 Техподдержка")
+    dp.message.register(start_support, F.text == SUPPORT_BUTTON)
     dp.message.register(handle_support_question, Form.support)
     dp.message.register(reply_to_user, Command("reply"))
-    dp.message.register(show_history, F.text == "🕓 История сигналов")
-    dp.message.register(show_news, F.text == "📰 Новости")
+    dp.message.register(show_history, F.text == HISTORY_BUTTON)
+    dp.message.register(show_news, F.text == NEWS_BUTTON)
     dp.message.register(manual_remind, Command("remind"))
+    dp.message.register(profile_cmd, Command("profile"))
+    dp.message.register(manual_reconcile, Command("reconcile"))
     dp.message.register(restore_menu_if_registered)
 
 
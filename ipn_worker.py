@@ -0,0 +1,214 @@
+"""Фоновая обработка IPN от NOWPayments.
+
+handle_ipn только проверяет подпись, сохраняет событие в ipn_events
+(уникальный ключ payment_id+status отсекает повторы) и сразу отвечает 200.
+Здесь события применяются к подпискам и пользователю отправляется уведомление.
+Продление идемпотентно по payment_id (subscription_payments): одна оплата,
+пришедшая разными событиями (finished от IPN, PAID от сверки), даёт срок один раз.
+Шардирование по subscription_id сохраняет порядок событий одной подписки.
+"""
+import asyncio
+import json
+import logging
+import time
+import zlib
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+import db
+import metrics
+from config import IPN_WORKERS, IPN_MAX_ATTEMPTS
+from entitlements import refresh_active_until
+from user_context import invalidate
+
+PAID_STATUSES = ("finished", "PAID")
+
+# Продление действующей подписки считается от её конца, а не от NOW().
+# expire_at стоит раньше status: SET выполняется слева направо.
+ACTIVATE_SQL = """
+    UPDATE subscriptions
+       SET expire_at  = DATE_ADD(
+               IF(status = 'ACTIVE' AND expire_at > NOW(), expire_at, NOW()),
+               INTERVAL %s DAY),
+           status     = 'ACTIVE',
+           updated_at = NOW()
+     WHERE subscription_id = %s
+"""
+
+RECORD_PAYMENT_SQL = """
+    INSERT IGNORE INTO subscription_payments (payment_id, subscription_id, applied_at)
+    VALUES (%s, %s, NOW())
+"""
+
+_queues: list[asyncio.Queue] = []
+_tasks: list[asyncio.Task] = []
+_bot: Bot | None = None
+
+
+async def persist(event_key: str, sub_id: str, status: str | None, raw: bytes) -> int | None:
+    """Сохраняет событие; None — такое событие уже приходило."""
+    async with db.acquire() as conn:
+        inserted = await conn.execute(
+            "INSERT IGNORE INTO ipn_events (event_key, subscription_id, status, payload, received_at) "
+            "VALUES (%s, %s, %s, %s, NOW())",
+            (event_key, sub_id, status, raw.decode("utf-8", "replace"))
+        )
+        if not inserted:
+            return None
+        row = await conn.fetchone("SELECT LAST_INSERT_ID()")
+        return row[0]
+
+
+def enqueue(event_id: int, sub_id: str, status: str | None):
+    if not _queues:
+        return  # воркеры не запущены — событие подхватит load_pending при старте
+    shard = zlib.crc32(str(sub_id).encode()) % len(_queues)
+    _queues[shard].put_nowait((event_id, sub_id, status, time.perf_counter()))
+
+
+def depth() -> dict:
+    sizes = [q.qsize() for q in _queues]
+    return {"pending": sum(sizes), "workers": sizes}
+
+
+metrics.Gauge("bot_ipn_queue_depth", "IPN events waiting for a worker", fn=lambda: depth()["pending"])
+
+
+# ─── Применение события ───────────────────────────────────────────────────────
+def payment_id(data: dict) -> str | None:
+    """id оплаты NOWPayments — общий у IPN и у счетов, которые видит сверка."""
+    value = data.get("payment_id")
+    return str(value)[:64] if value else None
+
+
+async def record_payment(conn: db.Connection, payment: str, sub_id: str) -> bool:
+    """False — эта оплата уже продлила подписку."""
+    return bool(await conn.execute(RECORD_PAYMENT_SQL, (payment, sub_id)))
+
+
+async def _apply(event_id: int, sub_id: str, status: str | None) -> int | None:
+    """Возвращает user_id, если подписка активирована и нужно уведомление."""
+    async with db.transaction() as conn:
+        # Блокируем строку события: одно и то же событие не применится дважды
+        row = await conn.fetchone(
+            "SELECT processed_at, payload FROM ipn_events WHERE id = %s FOR UPDATE", (event_id,)
+        )
+        if not row or row[0] is not None:
+            return None
+        try:
+            payment = payment_id(json.loads(row[1] or "{}"))
+        except ValueError:
+            payment = None
+
+        user_id = None
+        if status in PAID_STATUSES:
+            from payments import plan_days
+
+            row = await conn.fetchone(
+                "SELECT user_id, plan_id FROM subscriptions WHERE subscription_id = %s", (sub_id,)
+            )
+            if not row:
+                logging.warning(f"❌ Unknown subscription: {sub_id}")
+            elif payment is None:
+                logging.error(f"❌ Paid IPN for {sub_id} without payment_id, not applied")
+            elif not await record_payment(conn, payment, sub_id):
+                logging.info(f"📩 Payment {payment} already applied to {sub_id}")
+            else:
+                user_id, plan_id = row
+                await conn.execute(ACTIVATE_SQL, (plan_days(plan_id), sub_id))
+                await refresh_active_until(conn, user_id)
+
+        await conn.execute(
+            "UPDATE ipn_events SET processed_at = NOW(), attempts = attempts + 1, last_error = NULL "
+            "WHERE id = %s",
+            (event_id,)
+        )
+    if user_id is not None:
+        invalidate(user_id)
+    return user_id
+
+
+async def notify_activated(bot: Bot, user_id: int):
+    for _ in range(3):
+        try:
+            await bot.send_message(user_id, "✅ Ваша подписка успешно активирована!")
+            return
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logging.warning(f"❌ Не удалось уведомить {user_id} об активации: {e}")
+            return
+
+
+async def _process(event_id: int, sub_id: str, status: str | None):
+    delay = 1.0
+    for attempt in range(1, IPN_MAX_ATTEMPTS + 1):
+        try:
+            user_id = await _apply(event_id, sub_id, status)
+            break
+        except Exception as e:
+            logging.exception(f"❌ IPN event {event_id} failed (attempt {attempt})")
+            try:
+                await db.execute(
+                    "UPDATE ipn_events SET attempts = attempts + 1, last_error = %s WHERE id = %s",
+                    (str(e)[:1000], event_id)
+                )
+            except Exception:
+                pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+    else:
+        # Остаётся с processed_at IS NULL и будет подхвачено при следующем старте
+        logging.error(f"❌ IPN event {event_id} gave up after {IPN_MAX_ATTEMPTS} attempts")
+        metrics.IPN_FAILURES.inc()
+        return
+
+    if user_id is not None:
+        await notify_activated(_bot, user_id)
+
+
+async def _worker(queue: asyncio.Queue):
+    while True:
+        event_id, sub_id, status, enqueued = await queue.get()
+        try:
+            await _process(event_id, sub_id, status)
+        finally:
+            metrics.IPN_PROCESS_SECONDS.observe(time.perf_counter() - enqueued)
+            queue.task_done()
+
+
+async def load_pending():
+    rows = await db.fetchall(
+        "SELECT id, subscription_id, status FROM ipn_events "
+        "WHERE processed_at IS NULL ORDER BY id"
+    )
+    for event_id, sub_id, status in rows:
+        enqueue(event_id, sub_id, status)
+    if rows:
+        logging.info("📥 Requeued %s pending IPN events", len(rows))
+
+
+async def start(bot: Bot, workers: int = IPN_WORKERS):
+    global _bot
+    _bot = bot
+    _queues[:] = [asyncio.Queue() for _ in range(workers)]
+    _tasks[:] = [asyncio.create_task(_worker(q)) for q in _queues]
+    await load_pending()
+    logging.info("🟢 IPN workers started: %s", workers)
+
+
+async def stop(timeout: float = 10.0):
+    try:
+        await asyncio.wait_for(asyncio.gather(*(q.join() for q in _queues)), timeout)
+    except asyncio.TimeoutError:
+        logging.warning("⚠️ IPN queue not drained on shutdown: %s", depth())
+    for task in _tasks:
+        task.cancel()
+    _tasks.clear()
+    _queues.clear()
+
+
+def event_key(data: dict, sub_id: str, status: str | None) -> str:
+    payment_id = data.get("payment_id") or data.get("invoice_id") or sub_id
+    return f"{payment_id}:{status}"[:191]
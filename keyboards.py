@@ -2,36 +2,98 @@ from aiogram.types import (
     InlineKeyboardButton, InlineKeyboardMarkup,
     ReplyKeyboardMarkup, KeyboardButton
 )
-from locale_utils import load_messages
+from locale_utils import catalog, DEFAULT_LANG
 from payments import SUBSCRIPTION_PLANS
 
+SUPPORT_BUTTON = "📩 Техподдержка"
+HISTORY_BUTTON = "🕓 История сигналов"
+NEWS_BUTTON    = "📰 Новости"
 
-def language_kb() -> InlineKeyboardMarkup:
+
+# ─── Сборка ───────────────────────────────────────────────────────────────────
+def _language_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton(text="English", callback_data="lang:en"),
         InlineKeyboardButton(text="Русский", callback_data="lang:ru"),
     ]])
 
 
-def reset_kb() -> InlineKeyboardMarkup:
+def _reset_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔄 Reset", callback_data="action:reset")]
     ])
 
-def buy_kb(lang: str) -> InlineKeyboardMarkup:
+
+def _buy_kb(lang: str) -> InlineKeyboardMarkup:
     buttons = []
     for key, plan in SUBSCRIPTION_PLANS.items():
-        label = plan[f"label_{lang}"]
+        label = plan.get(f"label_{lang}") or plan[f"label_{DEFAULT_LANG}"]
         buttons.append([InlineKeyboardButton(text=label, callback_data=f"buy:{key}")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def main_menu_kb(lang: str) -> ReplyKeyboardMarkup:
-    msgs = load_messages(lang)
+def _main_menu_kb(lang: str) -> ReplyKeyboardMarkup:
+    msgs = catalog.messages(lang)
     return ReplyKeyboardMarkup(
         keyboard=[[
             KeyboardButton(text=msgs["signals_button"]),
             KeyboardButton(text=msgs["commands_button"]),
+            KeyboardButton(text=SUPPORT_BUTTON),
+            KeyboardButton(text=HISTORY_BUTTON),
+            KeyboardButton(text=NEWS_BUTTON)
         ]],
         resize_keyboard=True
-    )
\ No newline at end of file
+    )
+
+
+# ─── Реестр ───────────────────────────────────────────────────────────────────
+class KeyboardRegistry:
+    """Все варианты клавиатур (клавиатура × язык) собираются один раз.
+
+    Объекты aiogram — frozen pydantic-модели, поэтому один экземпляр безопасно
+    отдавать во все сообщения. Если каталог локалей перезагрузился, реестр
+    пересобирается при следующем обращении.
+    """
+
+    def __init__(self):
+        self._static: dict[str, InlineKeyboardMarkup] = {}
+        self._by_lang: dict[tuple[str, str], InlineKeyboardMarkup | ReplyKeyboardMarkup] = {}
+        self._version = None
+
+    def build(self):
+        self._static = {"language": _language_kb(), "reset": _reset_kb()}
+        self._by_lang = {}
+        for lang in catalog.languages:
+            self._by_lang[("buy", lang)] = _buy_kb(lang)
+            self._by_lang[("main_menu", lang)] = _main_menu_kb(lang)
+        self._version = catalog.version
+
+    def static(self, name: str):
+        if self._version != catalog.version:
+            self.build()
+        return self._static[name]
+
+    def localized(self, name: str, lang: str | None):
+        if self._version != catalog.version:
+            self.build()
+        return self._by_lang.get((name, lang)) or self._by_lang[(name, DEFAULT_LANG)]
+
+
+registry = KeyboardRegistry()
+registry.build()
+
+
+def language_kb() -> InlineKeyboardMarkup:
+    return registry.static("language")
+
+
+def reset_kb() -> InlineKeyboardMarkup:
+    return registry.static("reset")
+
+
+def buy_kb(lang: str) -> InlineKeyboardMarkup:
+    return registry.localized("buy", lang)
+
+
+def main_menu_kb(lang: str) -> ReplyKeyboardMarkup:
+    return registry.localized("main_menu", lang)
@@ -1,6 +1,117 @@
 import json
+import logging
+import os
+import time
+from string import Formatter
+from types import MappingProxyType
 
+LOCALES_DIR     = os.getenv("LOCALES_DIR", "locales")
+DEFAULT_LANG    = "en"
+HOT_RELOAD      = os.getenv("LOCALES_HOT_RELOAD", "0") == "1"
+RELOAD_INTERVAL = float(os.getenv("LOCALES_RELOAD_INTERVAL", "2"))
 
-def load_messages(lang: str) -> dict:
-    with open(f"locales/{lang}.json", encoding="utf-8") as f:
-        return json.load(f)
\ No newline at end of file
+
+# ─── Шаблоны ──────────────────────────────────────────────────────────────────
+class Template(str):
+    """Строка сообщения с заранее разобранными плейсхолдерами.
+
+    Остаётся обычной str, поэтому msgs[key] и msgs[key].format(...) работают
+    как раньше; render() собирает текст без повторного парсинга формата.
+    """
+
+    def __new__(cls, text: str):
+        obj = super().__new__(cls, text)
+        parts = []
+        for literal, field, spec, conv in Formatter().parse(text):
+            if field is not None and (spec or conv or not field.isidentifier()):
+                parts = None  # сложный формат — отдаём str.format
+                break
+            parts.append((literal, field))
+        obj._parts = tuple(parts) if parts is not None else None
+        return obj
+
+    def render(self, **kwargs) -> str:
+        if self._parts is None:
+            return self.format(**kwargs)
+        return "".join(
+            literal + (str(kwargs[field]) if field is not None else "")
+            for literal, field in self._parts
+        )
+
+
+# ─── Каталог ──────────────────────────────────────────────────────────────────
+class Catalog:
+    def __init__(self, directory: str = LOCALES_DIR, default: str = DEFAULT_LANG,
+                 hot_reload: bool = HOT_RELOAD):
+        self.directory = directory
+        self.default = default
+        self.hot_reload = hot_reload
+        self._mtimes: dict[str, float] = {}
+        self._checked = 0.0
+        self._langs = MappingProxyType({})
+        self.version = 0
+        self.load()
+
+    def _scan(self) -> dict[str, float]:
+        return {
+            name[:-5]: os.stat(os.path.join(self.directory, name)).st_mtime
+            for name in os.listdir(self.directory)
+            if name.endswith(".json")
+        }
+
+    def load(self):
+        mtimes = self._scan()
+        raw = {}
+        for lang in mtimes:
+            with open(os.path.join(self.directory, f"{lang}.json"), encoding="utf-8") as f:
+                raw[lang] = json.load(f)
+
+        base = raw.get(self.default, {})
+        langs = {}
+        for lang, msgs in raw.items():
+            merged = {**base, **msgs}  # недостающие ключи берём из en
+            langs[lang] = MappingProxyType({k: Template(v) if isinstance(v, str) else v
+                                            for k, v in merged.items()})
+
+        # Подмена одной ссылкой: читатели видят либо старый, либо новый каталог
+        self._langs = MappingProxyType(langs)
+        self._mtimes = mtimes
+        self._checked = time.monotonic()
+        self.version += 1
+        logging.info("🌐 Locales loaded: %s", ", ".join(sorted(langs)))
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked < RELOAD_INTERVAL:
+            return
+        self._checked = now
+        try:
+            if self._scan() != self._mtimes:
+                self.load()
+        except (OSError, ValueError):
+            logging.exception("❌ Failed to reload locales, keeping previous catalog")
+
+    @property
+    def languages(self) -> tuple[str, ...]:
+        return tuple(self._langs)
+
+    def messages(self, lang: str | None):
+        if self.hot_reload:
+            self._maybe_reload()
+        langs = self._langs
+        return langs.get(lang) or langs[self.default]
+
+    def get(self, lang: str | None, key: str, **kwargs) -> str:
+        template = self.messages(lang)[key]
+        return template.render(**kwargs) if kwargs else template
+
+
+catalog = Catalog()
+
+
+def load_messages(lang: str):
+    return catalog.messages(lang)
+
+
+def t(lang: str, key: str, **kwargs) -> str:
+    return catalog.get(lang, key, **kwargs)
@@ -0,0 +1,149 @@
+"""Сторож event loop: замеряет лаг и ловит блокирующие вызовы.
+
+Корутина-heartbeat просыпается каждые LOOP_MONITOR_INTERVAL секунд. Отдельный
+поток следит, когда она билась в последний раз: если loop не отвечает дольше
+LOOP_LAG_THRESHOLD, поток снимает стек главного потока — в нём видна вся
+цепочка await от задачи до блокирующего вызова — и приписывает зависание
+самому внешнему кадру кода бота (хэндлер, джоба, воркер).
+
+Последние зависания — в логах и на GET /debug/loop.
+"""
+import asyncio
+import collections
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from aiohttp import web
+
+import metrics
+from config import LOOP_LAG_THRESHOLD, LOOP_MONITOR_INTERVAL, LOOP_STALL_HISTORY, DEBUG_TOKEN
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Обвязка, через которую проходит любой апдейт — виновником её не считаем
+INFRA_FILES = {
+    "loop_monitor.py", "metrics.py", "user_context.py", "webhook.py", "main.py",
+    "backpressure.py", "profiler.py", "shard.py",
+}
+STACK_LIMIT = 40
+
+LOOP_LAG    = metrics.Histogram("bot_loop_lag_seconds", "Event loop scheduling delay",
+                                buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+LOOP_STALLS = metrics.Counter("bot_loop_stalls_total", "Event loop stalls over threshold", ("culprit",))
+
+
+def _culprit(stack: traceback.StackSummary) -> str:
+    for frame in stack:  # от внешнего кадра к внутреннему
+        directory, name = os.path.split(frame.filename)
+        if directory == PROJECT_DIR and name not in INFRA_FILES:
+            return f"{name[:-3]}.{frame.name}"
+    return "unknown"
+
+
+def _blocking_site(stack: traceback.StackSummary) -> str:
+    frame = stack[-1]
+    return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+
+
+class LoopMonitor:
+    def __init__(self, threshold: float = LOOP_LAG_THRESHOLD,
+                 interval: float = LOOP_MONITOR_INTERVAL, history: int = LOOP_STALL_HISTORY):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls: "collections.deque[dict]" = collections.deque(maxlen=history)
+        self.by_culprit: collections.Counter = collections.Counter()
+        self.max_lag = 0.0
+        self._beat = time.monotonic()
+        self._stall: dict | None = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._watcher: threading.Thread | None = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            previous, self._beat = self._beat, now
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG.observe(lag)
+            with self._lock:
+                stall, self._stall = self._stall, None
+            if stall is not None:
+                stall["duration"] = round(now - previous, 3)
+                logging.warning("🐢 Event loop blocked %.2fs by %s at %s",
+                                stall["duration"], stall["culprit"], stall["where"])
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            if time.monotonic() - beat < self.interval + self.threshold or self._stall is not None:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)[-STACK_LIMIT:]
+            del frame
+            stall = {
+                "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "culprit": _culprit(stack),
+                "where": _blocking_site(stack),
+                "duration": None,  # заполнит heartbeat, когда loop оживёт
+                "stack": [f"{f.filename}:{f.lineno} in {f.name}" for f in stack],
+            }
+            with self._lock:
+                if beat != self._beat:
+                    continue  # loop успел проснуться, пока снимали стек
+                self._stall = stall
+            self.stalls.append(stall)
+            self.by_culprit[stall["culprit"]] += 1
+            LOOP_STALLS.inc(stall["culprit"])
+            logging.warning("🐢 Event loop stalled > %.2fs in %s\n%s", self.threshold, stall["culprit"],
+                            "".join(traceback.format_list(stack)))
+
+    async def start(self):
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._watcher = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        self._watcher.start()
+        logging.info("🟢 Event loop monitor started (threshold %.2fs)", self.threshold)
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def snapshot(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "max_lag": round(self.max_lag, 3),
+            "by_culprit": dict(self.by_culprit.most_common()),
+            "stalls": list(reversed(self.stalls)),
+        }
+
+
+monitor = LoopMonitor()
+
+
+# ─── Debug-роуты ──────────────────────────────────────────────────────────────
+def authorized(request: web.Request) -> bool:
+    """Debug-роуты висят на публичном порту IPN/webhook: без токена — закрыты."""
+    if not DEBUG_TOKEN:
+        return False
+    return hmac.compare_digest(request.query.get("token", ""), DEBUG_TOKEN)
+
+
+async def handle_debug_loop(request: web.Request) -> web.Response:
+    if not authorized(request):
+        return web.Response(status=403, text="Forbidden")
+    return web.json_response(monitor.snapshot())
@@ -5,17 +5,32 @@ from aiohttp import web
 from aiogram import Bot
 from aiogram import Dispatcher
 
-from payments import create_app      # aiohttp-приложение с IPN-роутом
+import db
+import ipn_worker
+import metrics
+from payments import create_app, close_client      # aiohttp-приложение с IPN-роутом
 from handlers import register_handlers
+from webhook import setup_webhook
+from config import BOT_MODE, HTTP_PORT, FSM_STORAGE, WORKERS
+from fsm_storage import MySQLStorage
+from shard import ShardRouter, poll
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from remind import remind_unpaid_users
 from reminders import weekly_motivation_reminder
+from signal_delivery import cursors
+from archive import run_maintenance as run_archive_maintenance
+from loop_monitor import monitor as loop_monitor
+from expiry import ExpirySweeper
+from reconcile import reconcile
+from checkout import checkout
+from user_writes import user_writes
+import migrations
 
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=__import__("os").getenv("TELEGRAM_TOKEN"))
-dp  = Dispatcher()
+bot = metrics.instrument_bot(Bot(token=__import__("os").getenv("TELEGRAM_TOKEN")))
+dp  = Dispatcher(storage=MySQLStorage() if FSM_STORAGE == "mysql" else None)
 register_handlers(dp, bot)
 
 def start_reminder_scheduler(bot: Bot):
@@ -24,24 +39,66 @@ def start_reminder_scheduler(bot: Bot):
     scheduler.start()
 
 async def start_bot():
+    # getUpdates не работает при установленном вебхуке
+    await bot.delete_webhook()
     logging.info("🟢 Telegram polling started")
     await dp.start_polling(bot)
 
 
-async def start_ipn():
+async def start_http(router: ShardRouter | None = None) -> web.AppRunner:
     app = create_app()
+    if BOT_MODE == "webhook":
+        setup_webhook(app, dp, bot, router)
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", 8000)
+    site = web.TCPSite(runner, "0.0.0.0", HTTP_PORT)
     await site.start()
-    logging.info("🟢 IPN server listening on port 8000")
+    logging.info("🟢 HTTP server listening on port %s (%s mode)", HTTP_PORT, BOT_MODE)
+    return runner
 
 async def main():
-    scheduler = AsyncIOScheduler()
+    await loop_monitor.start()
+    await db.init_pool()
+    await migrations.upgrade()
+    await ipn_worker.start(bot)
+    await cursors.start()
+    await user_writes.start()
+    sweeper = ExpirySweeper(bot)
+    await sweeper.start()
+
+    scheduler = metrics.instrument_scheduler(AsyncIOScheduler())
     scheduler.add_job(remind_unpaid_users, "cron", hour=12, kwargs={"bot": bot})
+    scheduler.add_job(run_archive_maintenance, "cron", hour=4)
+    scheduler.add_job(reconcile, "cron", minute=30, kwargs={"bot": bot})
     scheduler.start()
 
-    await asyncio.gather(start_ipn(), start_bot())
+    # WORKERS > 1: апдейты обрабатывают процессы-воркеры, здесь только приём и фон
+    router = ShardRouter(bot) if WORKERS > 1 else None
+    if router:
+        await router.start()
+
+    runner = await start_http(router)
+    try:
+        if BOT_MODE == "webhook":
+            await asyncio.Event().wait()
+        elif router:
+            await poll(bot, router, dp.resolve_used_update_types())
+        else:
+            await start_bot()
+    finally:
+        await runner.cleanup()
+        if router:
+            await router.stop()
+        scheduler.shutdown(wait=False)
+        await sweeper.stop()
+        await checkout.stop()
+        await ipn_worker.stop()
+        await cursors.stop()
+        await user_writes.stop()
+        await close_client()
+        await db.close_pool()
+        await bot.session.close()
+        await loop_monitor.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
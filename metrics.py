@@ -0,0 +1,239 @@
+"""Метрики в текстовом формате Prometheus на GET /metrics.
+
+Без сторонних зависимостей: счётчики и гистограммы — словари с кортежами
+значений меток, на горячем пути только сложение и bisect по границам бакетов.
+"""
+import re
+import time
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Any, Awaitable, Callable
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import TelegramObject
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+JOB_BUCKETS     = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+_registry: list["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# ─── Типы метрик ──────────────────────────────────────────────────────────────
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        _registry.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        head = f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n"
+        return head + "".join(line + "\n" for line in self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, value: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + value
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_labels(self.labels, k)} {v:g}" for k, v in list(self._values.items())]
+
+
+class Gauge(_Metric):
+    """Значение либо выставляется set(), либо читается из fn при каждом скрейпе."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 fn: Callable[[], dict[tuple, float] | float] | None = None):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+        self.fn = fn
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def samples(self) -> list[str]:
+        values = self._values
+        if self.fn is not None:
+            result = self.fn()
+            values = result if isinstance(result, dict) else {(): result}
+        return [f"{self.name}{_labels(self.labels, k)} {v:g}" for k, v in list(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}  # labels → [counts по бакетам + +Inf, sum]
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = 'le="%s"' % (bound if isinstance(bound, str) else f"{bound:g}")
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total:g}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    return "".join(metric.render() for metric in _registry)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+# ─── Метрики приложения ───────────────────────────────────────────────────────
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler latency", ("handler", "event"))
+HANDLER_ERRORS  = Counter("bot_handler_errors_total", "Handler exceptions", ("handler", "event"))
+
+DB_SECONDS = Histogram("bot_db_query_seconds", "MySQL query latency", ("query",))
+DB_ERRORS  = Counter("bot_db_query_errors_total", "MySQL query errors", ("query",))
+
+TG_SECONDS     = Histogram("bot_telegram_request_seconds", "Bot API request latency", ("method",))
+TG_ERRORS      = Counter("bot_telegram_errors_total", "Bot API errors", ("method",))
+TG_FLOOD_WAITS = Counter("bot_telegram_flood_waits_total", "Bot API 429 responses", ("method",))
+
+IPN_ACCEPT_SECONDS  = Histogram("bot_ipn_accept_seconds", "IPN webhook response time")
+IPN_PROCESS_SECONDS = Histogram("bot_ipn_process_seconds", "IPN apply time, queue wait included")
+IPN_FAILURES        = Counter("bot_ipn_failures_total", "IPN events given up after retries")
+
+BROADCAST_SECONDS  = Histogram("bot_broadcast_seconds", "Broadcast job duration", ("job",), JOB_BUCKETS)
+BROADCAST_MESSAGES = Counter("bot_broadcast_messages_total", "Broadcast deliveries", ("job", "status"))
+BROADCAST_RATE     = Gauge("bot_broadcast_last_rate", "Messages per second of the last run", ("job",))
+
+JOB_LAG     = Histogram("bot_scheduler_lag_seconds", "Delay between scheduled and actual job start", ("job",))
+JOB_SECONDS = Histogram("bot_scheduler_job_seconds", "Scheduled job duration", ("job",), JOB_BUCKETS)
+JOB_ERRORS  = Counter("bot_scheduler_job_errors_total", "Scheduled job failures and misfires", ("job", "kind"))
+
+
+_QUERY_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+`?(\w+)", re.I)
+
+
+@lru_cache(maxsize=1024)
+def query_name(sql: str) -> str:
+    """«SELECT users», «INSERT signal_cursors»… — по первому глаголу и таблице."""
+    words = sql.split(None, 1)
+    if not words:
+        return "?"
+    verb = words[0].upper()
+    match = _QUERY_TABLE.search(sql)
+    return f"{verb} {match.group(1)}" if match else verb
+
+
+# ─── Инструментирование ───────────────────────────────────────────────────────
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: к этому моменту хэндлер уже выбран фильтрами."""
+
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_obj = data.get("handler")
+        name = getattr(handler_obj.callback, "__name__", "?") if handler_obj else "?"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name, self.event)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name, self.event)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            TG_FLOOD_WAITS.inc(name)
+            raise
+        except Exception:
+            TG_ERRORS.inc(name)
+            raise
+        finally:
+            TG_SECONDS.observe(time.perf_counter() - started, name)
+
+
+def instrument_bot(bot):
+    bot.session.middleware(TelegramMetricsMiddleware())
+    return bot
+
+
+def instrument_scheduler(scheduler):
+    from apscheduler.events import (
+        EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED,
+    )
+
+    started: dict[str, float] = {}
+
+    def name(job_id: str) -> str:
+        job = scheduler.get_job(job_id)
+        return job.name if job else job_id
+
+    def listener(event):
+        if event.code == EVENT_JOB_SUBMITTED:
+            started[event.job_id] = time.monotonic()
+            for run_time in event.scheduled_run_times:
+                lag = time.time() - run_time.timestamp()
+                JOB_LAG.observe(max(lag, 0.0), name(event.job_id))
+        elif event.code == EVENT_JOB_MISSED:
+            JOB_ERRORS.inc(name(event.job_id), "missed")
+        else:
+            begun = started.pop(event.job_id, None)
+            if begun is not None:
+                JOB_SECONDS.observe(time.monotonic() - begun, name(event.job_id))
+            if event.code == EVENT_JOB_ERROR:
+                JOB_ERRORS.inc(name(event.job_id), "error")
+
+    scheduler.add_listener(
+        listener, EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED
+    )
+    return scheduler
@@ -0,0 +1,325 @@
+"""Версионированная схема БД и проверка планов горячих запросов.
+
+    python migrations.py upgrade   — применить недостающие миграции
+    python migrations.py status    — показать применённые версии
+    python migrations.py check     — EXPLAIN для всех SQL-запросов бота;
+                                     код выхода 1, если где-то full table scan
+
+Миграции идемпотентны (IF NOT EXISTS, проверка индексов и колонок), поэтому
+их можно накатывать на базу, созданную раньше вручную. DDL в MySQL не
+транзакционен: версия записывается в schema_migrations после каждой миграции.
+
+Для check нужна база с данными, похожими на боевые: на пустых таблицах
+оптимизатор может выбрать полный скан даже при наличии индекса. Локально
+подойдёт контейнер: docker run -e MARIADB_ROOT_PASSWORD=... -p 3306:3306 mariadb
+"""
+import argparse
+import ast
+import asyncio
+import logging
+import os
+import re
+import sys
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import db
+
+Step = str | Callable[[db.Connection], Awaitable[None]]
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    steps: tuple[Step, ...]
+
+
+def add_column(table: str, column: str, definition: str) -> Step:
+    async def step(conn: db.Connection):
+        if not await db.has_column(conn, table, column):
+            await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+
+def add_index(table: str, name: str, columns: str, unique: bool = False) -> Step:
+    async def step(conn: db.Connection):
+        if not await db.has_index(conn, table, name):
+            kind = "UNIQUE INDEX" if unique else "INDEX"
+            await conn.execute(f"CREATE {kind} {name} ON {table} ({columns})")
+    return step
+
+
+MIGRATIONS: tuple[Migration, ...] = (
+    Migration(1, "base tables", (
+        """CREATE TABLE IF NOT EXISTS users (
+               user_id  BIGINT       PRIMARY KEY,
+               language VARCHAR(8)   NULL,
+               username VARCHAR(255) NULL,
+               email    VARCHAR(255) NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS subscriptions (
+               subscription_id VARCHAR(64)  PRIMARY KEY,
+               user_id         BIGINT       NOT NULL,
+               plan_id         VARCHAR(64)  NULL,
+               email           VARCHAR(255) NULL,
+               status          VARCHAR(32)  NOT NULL,
+               expire_at       DATETIME     NULL,
+               created_at      DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP,
+               updated_at      DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP
+           )""",
+        """CREATE TABLE IF NOT EXISTS signals (
+               id         BIGINT   AUTO_INCREMENT PRIMARY KEY,
+               text       TEXT     NOT NULL,
+               created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+           )""",
+        """CREATE TABLE IF NOT EXISTS signal_history (
+               id         BIGINT   PRIMARY KEY,
+               text       TEXT     NOT NULL,
+               created_at DATETIME NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS admins (
+               user_id       BIGINT  PRIMARY KEY,
+               is_authorized BOOLEAN NOT NULL DEFAULT FALSE
+           )""",
+    )),
+    Migration(2, "hot query indexes", (
+        # Доступ пользователя и пересчёт active_until
+        add_index("subscriptions", "idx_subscriptions_user_status_exp", "user_id, status, expire_at"),
+        # Истечение и сверка подписок по статусу
+        add_index("subscriptions", "idx_subscriptions_status_exp", "status, expire_at"),
+        add_index("signals", "idx_signals_created_at", "created_at"),
+        add_index("signal_history", "idx_signal_history_created_at", "created_at"),
+    )),
+    Migration(3, "users.active_until", (
+        add_column("users", "active_until", "DATETIME NULL"),
+        add_index("users", "idx_users_active_until", "active_until"),
+    )),
+    Migration(4, "broadcast state", (
+        """CREATE TABLE IF NOT EXISTS broadcast_checkpoints (
+               job          VARCHAR(64) PRIMARY KEY,
+               last_user_id BIGINT      NOT NULL,
+               updated_at   DATETIME    NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS blocked_users (
+               user_id    BIGINT   PRIMARY KEY,
+               blocked_at DATETIME NOT NULL
+           )""",
+    )),
+    Migration(5, "ipn events", (
+        """CREATE TABLE IF NOT EXISTS ipn_events (
+               id              BIGINT AUTO_INCREMENT PRIMARY KEY,
+               event_key       VARCHAR(191) NOT NULL,
+               subscription_id VARCHAR(64)  NOT NULL,
+               status          VARCHAR(32)  NULL,
+               payload         TEXT         NOT NULL,
+               received_at     DATETIME     NOT NULL,
+               processed_at    DATETIME     NULL,
+               attempts        INT          NOT NULL DEFAULT 0,
+               last_error      TEXT         NULL,
+               UNIQUE KEY uq_ipn_events_key (event_key),
+               KEY idx_ipn_events_pending (processed_at, id)
+           )""",
+    )),
+    Migration(6, "signal delivery", (
+        """CREATE TABLE IF NOT EXISTS signal_cursors (
+               user_id        BIGINT   PRIMARY KEY,
+               last_signal_id BIGINT   NOT NULL,
+               updated_at     DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+           )""",
+        """CREATE TABLE IF NOT EXISTS signal_deliveries (
+               signal_id    BIGINT      NOT NULL,
+               user_id      BIGINT      NOT NULL,
+               status       VARCHAR(16) NOT NULL,
+               delivered_at DATETIME    NOT NULL,
+               PRIMARY KEY (signal_id, user_id)
+           )""",
+    )),
+    Migration(7, "fsm state", (
+        """CREATE TABLE IF NOT EXISTS fsm_state (
+               bot_id     BIGINT       NOT NULL,
+               chat_id    BIGINT       NOT NULL,
+               user_id    BIGINT       NOT NULL,
+               thread_id  BIGINT       NOT NULL DEFAULT 0,
+               destiny    VARCHAR(64)  NOT NULL DEFAULT 'default',
+               state      VARCHAR(255) NULL,
+               data       TEXT         NULL,
+               updated_at DATETIME     NOT NULL,
+               PRIMARY KEY (bot_id, chat_id, user_id, thread_id, destiny)
+           )""",
+    )),
+    Migration(8, "subscriptions by status", (
+        # Keyset-обход подписок одного статуса (сверка с NOWPayments)
+        add_index("subscriptions", "idx_subscriptions_status_id", "status, subscription_id"),
+    )),
+    Migration(9, "applied payments", (
+        # Одна оплата продлевает подписку один раз, под каким бы ключом события она ни пришла
+        """CREATE TABLE IF NOT EXISTS subscription_payments (
+               payment_id      VARCHAR(64) PRIMARY KEY,
+               subscription_id VARCHAR(64) NOT NULL,
+               applied_at      DATETIME    NOT NULL
+           )""",
+    )),
+    Migration(10, "signal history ids", (
+        # У истории свой id: signals.id после очистки ленты может повториться,
+        # и перенос не должен упираться в уже занятый ключ
+        add_column("signal_history", "signal_id", "BIGINT NULL"),
+        "UPDATE signal_history SET signal_id = id WHERE signal_id IS NULL",
+        "ALTER TABLE signal_history MODIFY signal_id BIGINT NOT NULL",
+        "ALTER TABLE signal_history MODIFY id BIGINT NOT NULL AUTO_INCREMENT",
+        add_index("signal_history", "idx_signal_history_signal_id", "signal_id"),
+    )),
+)
+
+
+# ─── Применение ───────────────────────────────────────────────────────────────
+async def applied_versions(conn: db.Connection) -> set[int]:
+    await conn.execute(
+        """CREATE TABLE IF NOT EXISTS schema_migrations (
+               version    INT          PRIMARY KEY,
+               name       VARCHAR(255) NOT NULL,
+               applied_at DATETIME     NOT NULL
+           )"""
+    )
+    return {row[0] for row in await conn.fetchall("SELECT version FROM schema_migrations")}
+
+
+async def upgrade() -> list[int]:
+    applied = []
+    async with db.acquire() as conn:
+        done = await applied_versions(conn)
+        for migration in MIGRATIONS:
+            if migration.version in done:
+                continue
+            logging.info("🛠 Applying migration %s: %s", migration.version, migration.name)
+            for step in migration.steps:
+                if isinstance(step, str):
+                    await conn.execute(step)
+                else:
+                    await step(conn)
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, NOW())",
+                (migration.version, migration.name)
+            )
+            applied.append(migration.version)
+    if applied:
+        logging.info("✅ Schema upgraded to version %s", applied[-1])
+    return applied
+
+
+# ─── Проверка планов запросов ─────────────────────────────────────────────────
+QUERY_CALLS = {"execute", "executemany", "fetchone", "fetchall", "iter_keyset"}
+SQL_START   = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE)\b", re.I)
+FULL_SCAN_OK = "/* full-scan-ok */"
+SKIP_FILES  = {"migrations.py", "bench.py"}
+
+
+@dataclass
+class Query:
+    location: str
+    sql: str
+
+
+def _resolve(node: ast.AST, consts: dict[str, str]) -> str | None:
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.Name):
+        return consts.get(node.id)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left, right = _resolve(node.left, consts), _resolve(node.right, consts)
+        if left is not None and right is not None:
+            return left + right
+    return None  # f-строки и динамический SQL проверить статически нельзя
+
+
+def collect_queries(root: str = ".") -> tuple[list[Query], list[str]]:
+    queries, skipped = [], []
+    for name in sorted(os.listdir(root)):
+        if not name.endswith(".py") or name in SKIP_FILES:
+            continue
+        with open(os.path.join(root, name), encoding="utf-8") as f:
+            tree = ast.parse(f.read(), name)
+
+        consts = {}
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 \
+                    and isinstance(node.targets[0], ast.Name):
+                value = _resolve(node.value, consts)
+                if value is not None:
+                    consts[node.targets[0].id] = value
+
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call) or not node.args:
+                continue
+            func = node.func
+            fname = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+            if fname not in QUERY_CALLS:
+                continue
+            location = f"{name}:{node.lineno}"
+            sql = _resolve(node.args[0], consts)
+            if sql is None:
+                skipped.append(location)
+            elif SQL_START.match(sql):
+                queries.append(Query(location, sql))
+    return queries, skipped
+
+
+def _explainable(sql: str) -> str:
+    # Плейсхолдеры заменяем литералом: для плана важна форма запроса, а не значения.
+    # Строка, а не число: сравнение VARCHAR-ключа с числом отключает индекс.
+    sql = re.sub(r"\bLIMIT\s+%s", "LIMIT 1", sql, flags=re.I)
+    return "EXPLAIN " + sql.replace("%s", "'1'")
+
+
+async def check() -> int:
+    queries, skipped = collect_queries()
+    failures = 0
+    async with db.acquire() as conn:
+        for query in queries:
+            if "information_schema" in query.sql:
+                continue
+            try:
+                plan = await conn.fetchall_dicts(_explainable(query.sql))
+            except Exception as e:
+                logging.warning("⚠️ %s: EXPLAIN failed: %s", query.location, e)
+                failures += 1
+                continue
+            scans = [
+                row for row in plan
+                if str(row.get("type")).upper() == "ALL"
+                and row.get("table") and not str(row["table"]).startswith("<")
+            ]
+            if scans and FULL_SCAN_OK not in query.sql:
+                failures += 1
+                tables = ", ".join(sorted({str(row["table"]) for row in scans}))
+                logging.error("❌ %s: full table scan on %s", query.location, tables)
+            else:
+                logging.info("✅ %s", query.location)
+    for location in skipped:
+        logging.info("⏭ %s: dynamic SQL, not checked", location)
+    logging.info("%s queries checked, %s problems", len(queries), failures)
+    return 1 if failures else 0
+
+
+async def _main(command: str) -> int:
+    await db.init_pool()
+    try:
+        if command == "upgrade":
+            await upgrade()
+        elif command == "status":
+            async with db.acquire() as conn:
+                done = await applied_versions(conn)
+            for migration in MIGRATIONS:
+                mark = "✅" if migration.version in done else "⏳"
+                print(f"{mark} {migration.version:3} {migration.name}")
+        else:
+            return await check()
+        return 0
+    finally:
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Schema migrations and query plan checks")
+    parser.add_argument("command", choices=["upgrade", "status", "check"])
+    sys.exit(asyncio.run(_main(parser.parse_args().command)))
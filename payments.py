@@ -1,11 +1,16 @@
 import os
 import time
+import asyncio
 import logging
 import httpx
-import uuid
+import hmac
+import json
+import hashlib
 from aiohttp import web
-from aiogram import Bot
-from db import get_conn
+import ipn_worker
+import loop_monitor
+import metrics
+import profiler
 
 # ─── Конфиг ────────────────────────────────────────────────────────────────────
 API_KEY        = os.getenv("NOWPAYMENTS_API_KEY")
@@ -14,40 +19,129 @@ ADMIN_PASSWORD = os.getenv("NOWPAYMENTS_ADMIN_PASSWORD")
 IPN_SECRET     = os.getenv("NOWPAYMENTS_IPN_SECRET")
 IPN_ROUTE      = "/nowpayments/ipn"
 BOT_TOKEN      = os.getenv("TELEGRAM_TOKEN")
-BASE_URL       = "https://api.nowpayments.io/v1"
+BASE_URL       = os.getenv("NOWPAYMENTS_BASE_URL", "https://api.nowpayments.io/v1")
 PLAN_ID        = os.getenv("NOWPAYMENTS_PLAN_ID")
 
+# days — срок доступа после оплаты; «навсегда» — 100 лет
 SUBSCRIPTION_PLANS = {
-    "monthly":     {"id": os.getenv("PLAN_ID_MONTHLY"), "label_ru": "📆 Месяц ($20)",      "label_en": "📆 1 Month ($20)"},
-    "quarterly":   {"id": os.getenv("PLAN_ID_QUARTERLY"), "label_ru": "📅 3 месяца ($50)", "label_en": "📅 3 Months ($50)"},
-    "yearly":      {"id": os.getenv("PLAN_ID_YEARLY"), "label_ru": "📈 Год ($120)",        "label_en": "📈 1 Year ($120)"},
-    "lifetime":    {"id": os.getenv("PLAN_ID_LIFETIME"), "label_ru": "♾️ Навсегда ($300)", "label_en": "♾️ Lifetime ($300)"}
+    "monthly":     {"id": os.getenv("PLAN_ID_MONTHLY"), "days": 30, "label_ru": "📆 Месяц ($20)",      "label_en": "📆 1 Month ($20)"},
+    "quarterly":   {"id": os.getenv("PLAN_ID_QUARTERLY"), "days": 90, "label_ru": "📅 3 месяца ($50)", "label_en": "📅 3 Months ($50)"},
+    "yearly":      {"id": os.getenv("PLAN_ID_YEARLY"), "days": 365, "label_ru": "📈 Год ($120)",        "label_en": "📈 1 Year ($120)"},
+    "lifetime":    {"id": os.getenv("PLAN_ID_LIFETIME"), "days": 36500, "label_ru": "♾️ Навсегда ($300)", "label_en": "♾️ Lifetime ($300)"}
 }
+DEFAULT_PLAN_DAYS = 30
+
+
+def plan_days(plan_id: str | None) -> int:
+    """Срок по id плана NOWPayments (в subscriptions.plan_id хранится именно он)."""
+    for plan in SUBSCRIPTION_PLANS.values():
+        if plan["id"] is not None and str(plan["id"]) == str(plan_id):
+            return plan["days"]
+    return DEFAULT_PLAN_DAYS
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
-bot = Bot(token=BOT_TOKEN)
+
+# ─── HTTP-клиент ──────────────────────────────────────────────────────────────
+# Один долгоживущий клиент на процесс: keep-alive, пул соединений, HTTP/2 если
+# установлен пакет h2. Таймауты — отдельно на каждый эндпоинт.
+TIMEOUTS = {
+    "auth":          httpx.Timeout(10.0, connect=5.0),
+    "subscriptions": httpx.Timeout(15.0, connect=5.0),
+    "invoices":      httpx.Timeout(10.0, connect=5.0),
+}
+HTTP_RETRIES = int(os.getenv("NOWPAYMENTS_RETRIES", "3"))
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_client: httpx.AsyncClient | None = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=BASE_URL,
+            http2=_http2_available(),
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60),
+            headers={"x-api-key": API_KEY or ""},
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _request(method: str, path: str, *, endpoint: str, idempotent: bool = True,
+                   **kwargs) -> httpx.Response:
+    """Запрос с повторами и экспоненциальной паузой.
+
+    Неидемпотентные запросы (создание подписки) повторяются только если
+    соединение не было установлено — иначе можно создать подписку дважды.
+    """
+    client = get_client()
+    delay = 0.5
+    for attempt in range(HTTP_RETRIES + 1):
+        last = attempt == HTTP_RETRIES
+        try:
+            resp = await client.request(method, path, timeout=TIMEOUTS[endpoint], **kwargs)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+            if last:
+                raise
+        except httpx.TransportError:
+            if last or not idempotent:
+                raise
+        else:
+            if resp.status_code not in RETRY_STATUS or last or (not idempotent and resp.status_code != 429):
+                return resp
+            retry_after = resp.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+        logging.warning("🔁 NOWPayments %s %s retry %s in %.1fs", method, path, attempt + 1, delay)
+        await asyncio.sleep(delay)
+        delay *= 2
+
 
 # ─── JWT-кэш ──────────────────────────────────────────────────────────────────
 _jwt_cache = {"token": None, "expires": 0}
+_jwt_lock  = asyncio.Lock()
+
+
+def _jwt_valid() -> bool:
+    return bool(_jwt_cache["token"]) and time.time() < _jwt_cache["expires"] - 30
+
+
+def _invalidate_jwt():
+    _jwt_cache["token"] = None
+
 
 async def _get_jwt() -> str:
-    now = time.time()
-    if _jwt_cache["token"] and now < _jwt_cache["expires"] - 30:
+    if _jwt_valid():
         return _jwt_cache["token"]
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{BASE_URL}/auth",
-            headers={
-                "x-api-key": API_KEY,
-                "Content-Type": "application/json"
-            },
+    # Single-flight: одновременные вызовы ждут один и тот же /auth
+    async with _jwt_lock:
+        if _jwt_valid():
+            return _jwt_cache["token"]
+
+        now = time.time()
+        resp = await _request(
+            "POST", "/auth", endpoint="auth",
             json={
                 "email":    ADMIN_EMAIL,
                 "password": ADMIN_PASSWORD
             },
-            timeout=10.0
         )
         resp.raise_for_status()
         token = resp.json().get("token")
@@ -56,54 +150,80 @@ async def _get_jwt() -> str:
         logging.info("🔑 Acquired JWT")
         return token
 
+
+async def _authorized(method: str, path: str, *, endpoint: str, idempotent: bool = True,
+                      **kwargs) -> httpx.Response:
+    for attempt in range(2):
+        jwt = await _get_jwt()
+        resp = await _request(
+            method, path, endpoint=endpoint, idempotent=idempotent,
+            headers={"Authorization": f"Bearer {jwt}"}, **kwargs
+        )
+        # Токен мог истечь раньше срока — обновляем один раз
+        if resp.status_code != 401 or attempt:
+            return resp
+        if _jwt_cache["token"] == jwt:
+            _invalidate_jwt()
+    return resp
+
+
 async def create_email_subscription(email: str, plan_id: str) -> dict:
-    jwt = await _get_jwt()
     payload = {
         "subscription_plan_id": plan_id,
         "email": email
     }
-    headers = {
-        "Authorization": f"Bearer {jwt}",
-        "x-api-key": API_KEY,
-        "Content-Type": "application/json"
-    }
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(f"{BASE_URL}/subscriptions", json=payload, headers=headers)
-        resp.raise_for_status()
-        result = resp.json()["result"][0]
-        return result  # содержит id
+    resp = await _authorized("POST", "/subscriptions", endpoint="subscriptions",
+                             idempotent=False, json=payload)
+    resp.raise_for_status()
+    result = resp.json()["result"][0]
+    return result  # содержит id
+
 
-    
 async def fetch_subscription_invoices(subscription_id: str) -> list[dict]:
-    jwt = await _get_jwt()
-    headers = {
-        "Authorization": f"Bearer {jwt}",
-        "x-api-key":     API_KEY
-    }
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{BASE_URL}/subscriptions/{subscription_id}/invoices",
-            headers=headers,
-            timeout=10.0
-        )
-        if resp.status_code == 404:
-            return []
-        resp.raise_for_status()
-        data = resp.json()
-        return data.get("result", [])
+    resp = await _authorized("GET", f"/subscriptions/{subscription_id}/invoices",
+                             endpoint="invoices")
+    if resp.status_code == 404:
+        return []
+    resp.raise_for_status()
+    data = resp.json()
+    return data.get("result", [])
 
 # ─── Обработчик webhook IPN ──────────────────────────────────────────────────
+def verify_ipn_signature(data: dict, signature: str | None) -> bool:
+    """x-nowpayments-sig = HMAC-SHA512(IPN_SECRET, JSON с отсортированными ключами).
+
+    Без IPN_SECRET проверить подпись нечем — такие IPN отклоняются."""
+    if not IPN_SECRET or not signature:
+        return False
+    payload = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    expected = hmac.new(IPN_SECRET.encode(), payload.encode(), hashlib.sha512).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
 async def handle_ipn(request: web.Request) -> web.Response:
+    started = time.perf_counter()
+    try:
+        return await _accept_ipn(request)
+    finally:
+        metrics.IPN_ACCEPT_SECONDS.observe(time.perf_counter() - started)
+
+
+async def _accept_ipn(request: web.Request) -> web.Response:
+    # Быстрый путь: подпись, дедупликация, запись в ipn_events и сразу 200.
+    # Подписку и уведомление применяет ipn_worker в фоне.
     raw = await request.read()
     try:
-        data = await request.json()
-    except Exception:
-        logging.exception("❌ Failed to parse IPN JSON")
+        data = json.loads(raw)
+    except ValueError:
+        logging.warning("❌ Failed to parse IPN JSON")
         return web.Response(status=400, text="Bad JSON")
 
-    logging.info("📩 === IPN RECEIVED ===")
-    logging.info("📩 Headers: %s", dict(request.headers))
-    logging.info("📩 Body: %s", data)
+    logging.debug("📩 IPN headers: %s", dict(request.headers))
+    logging.debug("📩 IPN body: %s", data)
+
+    if not verify_ipn_signature(data, request.headers.get("x-nowpayments-sig")):
+        logging.warning("❌ Invalid IPN signature")
+        return web.Response(status=401, text="Bad signature")
 
     # Получаем статус и ID подписки
     status = data.get("payment_status") or data.get("status")
@@ -113,42 +233,30 @@ async def handle_ipn(request: web.Request) -> web.Response:
         logging.warning("❌ Нет subscription_id в IPN")
         return web.Response(status=400, text="No subscription_id")
 
-    if status in ("finished", "PAID"):
-        conn = get_conn(); cur = conn.cursor()
-
-        # Проверка: есть ли такая подписка
-        cur.execute("SELECT user_id FROM subscriptions WHERE subscription_id = %s", (sub_id,))
-        row = cur.fetchone()
-
-        if not row:
-            logging.warning(f"❌ Unknown subscription: {sub_id}")
-            cur.close(); conn.close()
-            return web.Response(text="Unknown subscription")
-
-        user_id = row[0]
-
-        # Обновление подписки
-        cur.execute("""
-            UPDATE subscriptions
-               SET status     = 'ACTIVE',
-                   expire_at  = DATE_ADD(NOW(), INTERVAL 30 DAY),
-                   updated_at = NOW()
-             WHERE subscription_id = %s
-        """, (sub_id,))
-        conn.commit()
-        cur.close(); conn.close()
-
-        # Отправка сообщения
-        await bot.send_message(user_id, "✅ Ваша подписка успешно активирована!")
+    event_id = await ipn_worker.persist(ipn_worker.event_key(data, sub_id, status), str(sub_id), status, raw)
+    if event_id is None:
+        logging.info("📩 Duplicate IPN %s/%s", sub_id, status)
+        return web.Response(text="OK")
 
+    ipn_worker.enqueue(event_id, str(sub_id), status)
+    logging.info("📩 IPN queued: %s %s", sub_id, status)
     return web.Response(text="OK")
 
 
+async def handle_ipn_queue(request: web.Request) -> web.Response:
+    return web.json_response(ipn_worker.depth())
 
 
 # ─── Создание aiohttp-приложения для IPN ──────────────────────────────────────
 def create_app() -> web.Application:
     app = web.Application()
     app.router.add_post(IPN_ROUTE, handle_ipn)
+    app.router.add_get(IPN_ROUTE + "/queue", handle_ipn_queue)
+    app.router.add_get("/metrics", metrics.handle_metrics)
+    app.router.add_get("/debug/loop", loop_monitor.handle_debug_loop)
+    app.router.add_get("/debug/profile", profiler.handle_debug_profile)
+    app.router.add_post("/debug/profile", profiler.handle_debug_profile_update)
+    if not IPN_SECRET:
+        logging.error("❌ NOWPAYMENTS_IPN_SECRET is not set — all IPNs will be rejected")
     logging.info("🟢 IPN app ready on %s", IPN_ROUTE)
     return app
@@ -0,0 +1,157 @@
+"""Выборочное профилирование апдейтов под живым трафиком.
+
+Middleware отмечает долю PROFILE_SAMPLE_RATE апдейтов. Пока такой апдейт
+обрабатывается, поток-сэмплер раз в PROFILE_INTERVAL секунд смотрит, какая
+задача сейчас занимает event loop, и если это отмеченный апдейт — снимает
+стек главного потока. Стеки копятся в формате collapsed stacks
+("message:show_signals;handlers.show_signals;… N"), который понимают
+flamegraph.pl и speedscope.
+
+Доля меняется на лету: /profile rate 0.01 или POST /debug/profile?rate=0.01.
+Выгрузка: /profile (файлом в чат) или GET /debug/profile (только чтение).
+"""
+import asyncio
+import collections
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from typing import Any, Awaitable, Callable
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from config import PROFILE_SAMPLE_RATE, PROFILE_INTERVAL, PROFILE_DIR
+from loop_monitor import authorized
+
+
+class Profiler:
+    def __init__(self, rate: float = PROFILE_SAMPLE_RATE, interval: float = PROFILE_INTERVAL,
+                 directory: str = PROFILE_DIR):
+        self.rate = rate
+        self.interval = interval
+        self.directory = directory
+        self.stacks: collections.Counter = collections.Counter()
+        self.profiled = 0
+        self.samples = 0
+        self._active: dict[asyncio.Task, str] = {}
+        self._wake = threading.Event()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread_id: int | None = None
+        self._thread: threading.Thread | None = None
+
+    def should_sample(self) -> bool:
+        return self.rate > 0 and random.random() < self.rate
+
+    def enter(self, tag: str) -> asyncio.Task:
+        task = asyncio.current_task()
+        if self._thread is None:
+            self._loop = asyncio.get_running_loop()
+            self._thread_id = threading.get_ident()
+            self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._thread.start()
+        self._active[task] = tag
+        self.profiled += 1
+        self._wake.set()
+        return task
+
+    def exit(self, task: asyncio.Task):
+        self._active.pop(task, None)
+
+    def _sample(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            while self._active:
+                time.sleep(self.interval)
+                tag = self._active.get(asyncio.current_task(self._loop))
+                if tag is None:
+                    continue  # loop занят неотмеченным апдейтом или простаивает
+                frame = sys._current_frames().get(self._thread_id)
+                if frame is not None:
+                    self._record(tag, frame)
+                    del frame
+
+    def _record(self, tag: str, frame):
+        names = []
+        while frame is not None and frame.f_code is not _MIDDLEWARE_CODE:
+            names.append(f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_qualname}")
+            frame = frame.f_back
+        names.append(tag)
+        self.stacks[";".join(reversed(names))] += 1
+        self.samples += 1
+
+    def reset(self):
+        self.stacks.clear()
+        self.profiled = 0
+        self.samples = 0
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def dump(self) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S.folded"))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.folded())
+        logging.info("🔥 Profile written to %s (%s samples)", path, self.samples)
+        return path
+
+    def summary(self) -> str:
+        return (f"rate={self.rate:g}, апдейтов: {self.profiled}, сэмплов: {self.samples}, "
+                f"уникальных стеков: {len(self.stacks)}")
+
+
+profiler = Profiler()
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    """Inner middleware: к этому моменту известен хэндлер, которым помечается профиль."""
+
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if not profiler.should_sample():
+            return await handler(event, data)
+        handler_obj = data.get("handler")
+        name = getattr(handler_obj.callback, "__name__", "?") if handler_obj else "?"
+        task = profiler.enter(f"{self.event}:{name}")
+        try:
+            return await handler(event, data)
+        finally:
+            profiler.exit(task)
+
+
+# Кадр middleware — граница, выше которой стек апдейта не интересен
+_MIDDLEWARE_CODE = ProfilingMiddleware.__call__.__code__
+
+
+# ─── Debug-роуты ──────────────────────────────────────────────────────────────
+async def handle_debug_profile(request: web.Request) -> web.Response:
+    """Текущий профиль в collapsed stacks; ничего не меняет и не пишет на диск."""
+    if not authorized(request):
+        return web.Response(status=403, text="Forbidden")
+    return web.Response(text=profiler.folded())
+
+
+async def handle_debug_profile_update(request: web.Request) -> web.Response:
+    """POST: ?rate=0.01 — сменить долю; ?reset=1 — обнулить профиль."""
+    if not authorized(request):
+        return web.Response(status=403, text="Forbidden")
+    if "rate" in request.query:
+        try:
+            profiler.rate = min(max(float(request.query["rate"]), 0.0), 1.0)
+        except ValueError:
+            return web.Response(status=400, text="Bad rate")
+    if request.query.get("reset") == "1":
+        profiler.reset()
+    return web.Response(text=profiler.summary() + "\n")
@@ -0,0 +1,220 @@
+"""Сверка подписок с NOWPayments на случай потерянных IPN.
+
+Обходит keyset-пачками подписки WAITING_PAY (не старше RECONCILE_PENDING_DAYS)
+и недавно активированные (RECONCILE_ACTIVE_DAYS), счета запрашивает
+параллельно: не больше RECONCILE_CONCURRENCY запросов сразу и не чаще
+RECONCILE_RATE в секунду. Оплаченные подписки активируются пачкой в одной
+транзакции. Оплата записывается в ipn_events ключом из тех же полей, что у IPN
+(payment_id и payment_status), и в subscription_payments по payment_id, поэтому
+опоздавший IPN её не применит повторно. Оплата, которую не удалось применить
+(подписка уже не WAITING_PAY), не записывается — её применит IPN, если придёт, —
+и попадает в отчёт. Счёт без payment_id сопоставить с IPN нельзя — он тоже
+не применяется, а попадает в отчёт.
+
+Активные подписки без оплаченного счёта только попадают в отчёт.
+
+    python reconcile.py
+"""
+import asyncio
+import json
+import logging
+import sys
+import time
+from dataclasses import dataclass, field
+
+from aiogram import Bot
+
+import db
+from broadcast import TokenBucket
+from config import (
+    RECONCILE_CONCURRENCY, RECONCILE_RATE, RECONCILE_PENDING_DAYS, RECONCILE_ACTIVE_DAYS,
+)
+from entitlements import refresh_active_until_many
+from ipn_worker import (
+    ACTIVATE_SQL, PAID_STATUSES, event_key, notify_activated, payment_id, record_payment,
+)
+from payments import fetch_subscription_invoices, plan_days
+from user_context import invalidate
+
+PENDING_SQL = """
+    SELECT subscription_id, user_id, plan_id, status FROM subscriptions
+     WHERE status = 'WAITING_PAY'
+       AND created_at > NOW() - INTERVAL %s DAY
+       AND subscription_id > %s
+  ORDER BY subscription_id
+     LIMIT %s
+"""
+
+RECENT_SQL = """
+    SELECT subscription_id, user_id, plan_id, status FROM subscriptions
+     WHERE status = 'ACTIVE'
+       AND updated_at > NOW() - INTERVAL %s DAY
+       AND subscription_id > %s
+  ORDER BY subscription_id
+     LIMIT %s
+"""
+
+# Только из WAITING_PAY: если IPN успел активировать подписку, второй раз не продлеваем
+ACTIVATE_PENDING_SQL = ACTIVATE_SQL + " AND status = 'WAITING_PAY'"
+
+APPLIED_SQL = "SELECT 1 FROM subscription_payments WHERE payment_id = %s"
+
+PAID = {status.lower() for status in PAID_STATUSES}
+MAX_LISTED = 20
+
+
+@dataclass
+class ReconcileReport:
+    checked: int = 0
+    activated: int = 0
+    already_applied: int = 0
+    unpaid: int = 0
+    unidentified: int = 0
+    not_activated: int = 0
+    errors: int = 0
+    anomalies: list[str] = field(default_factory=list)
+    started: float = field(default_factory=time.monotonic)
+    finished: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def summary(self) -> str:
+        text = (
+            f"Сверка: {self.checked} подписок проверено, {self.activated} активировано, "
+            f"{self.already_applied} уже применено, {self.unpaid} без оплаты, "
+            f"{self.unidentified} без payment_id, {self.not_activated} оплачено, но не активировано, "
+            f"{self.errors} ошибок API; {self.elapsed:.1f} c"
+        )
+        if self.anomalies:
+            listed = ", ".join(self.anomalies[:MAX_LISTED])
+            more = f" и ещё {len(self.anomalies) - MAX_LISTED}" if len(self.anomalies) > MAX_LISTED else ""
+            text += f"\n⚠️ Активны без оплаченного счёта: {listed}{more}"
+        return text
+
+
+def _paid_invoices(invoices: list[dict]) -> list[dict]:
+    return [
+        inv for inv in invoices
+        if str(inv.get("payment_status") or inv.get("status") or "").lower() in PAID
+    ]
+
+
+class Reconciler:
+    def __init__(self, bot: Bot | None = None, *, concurrency: int = RECONCILE_CONCURRENCY,
+                 rate: float = RECONCILE_RATE):
+        self.bot = bot
+        self.report = ReconcileReport()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._limiter = TokenBucket(rate)
+
+    async def _invoices(self, sub_id: str) -> list[dict] | None:
+        async with self._slots:
+            await self._limiter.acquire()
+            try:
+                return await fetch_subscription_invoices(sub_id)
+            except Exception as e:
+                self.report.errors += 1
+                logging.warning("❌ Reconcile: invoices for %s failed: %s", sub_id, e)
+                return None
+
+    async def _batches(self, sql: str, days: int, batch_size: int):
+        batch = []
+        async for row in db.iter_keyset(sql, (days,), start_after="", batch_size=batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def _check(self, rows: list[tuple]) -> list[tuple]:
+        """Запрашивает счета пачки и возвращает оплаты, которые нужно применить."""
+        results = await asyncio.gather(*(self._invoices(row[0]) for row in rows))
+        payments = []
+        for (sub_id, user_id, plan_id, status), invoices in zip(rows, results):
+            if invoices is None:
+                continue
+            self.report.checked += 1
+            paid = _paid_invoices(invoices)
+            identified = [inv for inv in paid if payment_id(inv)]
+            if status == "ACTIVE":
+                if not paid:
+                    self.report.anomalies.append(sub_id)
+            elif identified:
+                payments.append((sub_id, user_id, plan_id, identified[0]))
+            elif paid:
+                self.report.unidentified += 1
+                logging.warning("⚠️ Reconcile: paid invoice for %s has no payment_id, skipped", sub_id)
+            else:
+                self.report.unpaid += 1
+        return payments
+
+    async def _apply(self, payments: list[tuple]) -> list[int]:
+        activated = []
+        async with db.transaction() as conn:
+            for sub_id, user_id, plan_id, invoice in payments:
+                payment = payment_id(invoice)
+                if await conn.fetchone(APPLIED_SQL, (payment,)):
+                    self.report.already_applied += 1  # эту оплату уже применил IPN
+                    continue
+                if not await conn.execute(ACTIVATE_PENDING_SQL, (plan_days(plan_id), sub_id)):
+                    # Подписку отменили или она истекла после обхода: оплату не
+                    # отмечаем применённой, чтобы её IPN не отбросился как повтор
+                    self.report.not_activated += 1
+                    logging.warning("⚠️ Reconcile: %s is paid (%s) but no longer WAITING_PAY",
+                                    sub_id, payment)
+                    continue
+                await record_payment(conn, payment, sub_id)
+                status = invoice.get("payment_status") or invoice.get("status")
+                # Если IPN этой оплаты уже лежит в очереди, воркер увидит её в
+                # subscription_payments и повторно не продлит
+                await conn.execute(
+                    "INSERT IGNORE INTO ipn_events "
+                    "(event_key, subscription_id, status, payload, received_at, processed_at) "
+                    "VALUES (%s, %s, %s, %s, NOW(), NOW())",
+                    (event_key(invoice, sub_id, status), sub_id, status,
+                     json.dumps(invoice, ensure_ascii=False, default=str))
+                )
+                activated.append(user_id)
+            await refresh_active_until_many(conn, set(activated))
+        self.report.activated += len(activated)
+        return activated
+
+    async def _notify(self, user_ids: list[int]):
+        for user_id in user_ids:
+            invalidate(user_id)
+            if self.bot is not None:
+                await notify_activated(self.bot, user_id)
+
+    async def run(self, batch_size: int = 200) -> ReconcileReport:
+        for sql, days in ((PENDING_SQL, RECONCILE_PENDING_DAYS), (RECENT_SQL, RECONCILE_ACTIVE_DAYS)):
+            async for rows in self._batches(sql, days, batch_size):
+                payments = await self._check(rows)
+                if payments:
+                    await self._notify(await self._apply(payments))
+        self.report.finished = time.monotonic()
+        logging.info("✅ %s", self.report.summary())
+        return self.report
+
+
+async def reconcile(bot: Bot | None = None) -> ReconcileReport:
+    return await Reconciler(bot).run()
+
+
+async def _main() -> int:
+    from payments import close_client
+
+    await db.init_pool()
+    try:
+        report = await reconcile()
+        print(report.summary())
+        return 1 if report.errors else 0
+    finally:
+        await close_client()
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main()))
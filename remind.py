@@ -1,40 +1,29 @@
-import os
-import logging
 from aiogram import Bot
-from db import get_conn
+import db
+from broadcast import Broadcaster, BroadcastStats
 from locale_utils import load_messages
-from payments import SUBSCRIPTION_PLANS
 from keyboards import buy_kb
 
+UNPAID_USERS_SQL = """
+    SELECT u.user_id, u.language FROM users u
+    WHERE (u.active_until IS NULL OR u.active_until <= NOW())
+      AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.user_id = u.user_id)
+      AND u.user_id > %s
+    ORDER BY u.user_id
+    LIMIT %s
+"""
 
 
-async def remind_unpaid_users(bot: Bot):  
-    conn = get_conn()
-    cur = conn.cursor()
-    
-    cur.execute("""
-        SELECT u.user_id, u.language FROM users u
-        LEFT JOIN (
-            SELECT user_id, MAX(expire_at) AS max_exp
-            FROM subscriptions
-            WHERE status = 'ACTIVE' AND expire_at > NOW()
-            GROUP BY user_id
-        ) s ON u.user_id = s.user_id
-        WHERE s.max_exp IS NULL
-    """)
-    rows = cur.fetchall()
-    cur.close(); conn.close()
+def _build(user_id: int, lang: str) -> dict:
+    return {
+        "text": load_messages(lang)["pay_prompt_not"],
+        "reply_markup": buy_kb(lang),
+    }
 
-    for user_id, lang in rows:
-        if not lang:
-            lang = "en"
-        msgs = load_messages(lang)
-        try:
-            await bot.send_message(
-                user_id,
-                text=msgs["pay_prompt_not"],
-                reply_markup=buy_kb(lang)
-            )
-            print(f"✅ Отправлено {user_id}")
-        except Exception as e:
-            logging.warning(f"❌ Не удалось отправить {user_id}: {e}")
+
+def select_unpaid_users(start_after: int = 0):
+    return db.iter_keyset(UNPAID_USERS_SQL, start_after=start_after)
+
+
+async def remind_unpaid_users(bot: Bot) -> BroadcastStats:
+    return await Broadcaster(bot).run("remind_unpaid", select_unpaid_users, _build)
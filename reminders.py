@@ -1,22 +1,25 @@
-import os
-import logging
 from aiogram import Bot
-from db import get_conn
-from locale_utils import load_messages
-
-async def weekly_motivation_reminder(bot: Bot):
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT user_id, language FROM users")
-    users = cur.fetchall(); cur.close(); conn.close()
-
-    for uid, lang in users:
-        if not lang:
-            lang = "en"
-        msgs = load_messages(lang)
-        try:
-            await bot.send_message(
-                uid,
-                "📣 Не уверены в графике? 🧐 Подключите профессиональные сигналы и торгуйте уверенно! 💼🔥"
-            )
-        except Exception as e:
-            logging.warning(f"Не удалось отправить weekly reminder {uid}: {e}")
+import db
+from broadcast import Broadcaster, BroadcastStats
+
+WEEKLY_TEXT = "📣 Не уверены в графике? 🧐 Подключите профессиональные сигналы и торгуйте уверенно! 💼🔥"
+
+ALL_USERS_SQL = """
+    SELECT u.user_id, u.language FROM users u
+    WHERE NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.user_id = u.user_id)
+      AND u.user_id > %s
+    ORDER BY u.user_id
+    LIMIT %s
+"""
+
+
+def _build(user_id: int, lang: str) -> dict:
+    return {"text": WEEKLY_TEXT}
+
+
+def select_all_users(start_after: int = 0):
+    return db.iter_keyset(ALL_USERS_SQL, start_after=start_after)
+
+
+async def weekly_motivation_reminder(bot: Bot) -> BroadcastStats:
+    return await Broadcaster(bot).run("weekly_motivation", select_all_users, _build)
@@ -0,0 +1,263 @@
+"""Режим с несколькими процессами (WORKERS > 1).
+
+Главный процесс получает апдейты (polling или webhook), держит HTTP, IPN,
+планировщик и раскладывает апдейты по воркерам: user_id % WORKERS. Все
+апдейты пользователя попадают в один воркер и внутри него обрабатываются
+строго по очереди, разные пользователи — параллельно. FSM хранится в MySQL,
+так что воркеры можно перезапускать и менять их число.
+
+Кэши процессов согласуются сообщениями через те же очереди:
+сброс UserContext (оплата через IPN) уходит воркеру-владельцу,
+сброс ленты сигналов — всем процессам. Push новых сигналов идёт только в
+главном процессе: перед ним воркеры сбрасывают курсоры доставки в БД, после —
+каждый получает новые курсоры своих пользователей.
+"""
+import asyncio
+import logging
+import multiprocessing as mp
+import queue
+import threading
+from collections import defaultdict
+
+from aiogram import Bot, Dispatcher
+
+import db
+import metrics
+import signal_delivery
+import user_context
+from config import API_TOKEN, WORKERS, WORKER_CONCURRENCY, WORKER_QUEUE_SIZE
+from signal_feed import feed
+
+POLL_TIMEOUT = 30
+CURSOR_FLUSH_TIMEOUT = 10.0
+
+
+def user_of(raw: dict) -> int:
+    """user_id автора апдейта; апдейты без пользователя идут в воркер 0."""
+    for key, value in raw.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            owner = value.get(field)
+            if isinstance(owner, dict) and "id" in owner:
+                return owner["id"]
+    return 0
+
+
+def _pump(source, loop: asyncio.AbstractEventLoop, target: asyncio.Queue):
+    """Свой поток на чтение multiprocessing-очереди: не занимает потоки
+    default executor навсегда. Пока target полон, поток ждёт, и очередь
+    процесса заполняется — отправитель тормозит."""
+    while True:
+        item = source.get()
+        asyncio.run_coroutine_threadsafe(target.put(item), loop).result()
+        if item[0] == "stop":
+            return
+
+
+def read_queue(source, name: str) -> asyncio.Queue:
+    target: asyncio.Queue = asyncio.Queue(maxsize=1)
+    threading.Thread(target=_pump, args=(source, asyncio.get_running_loop(), target),
+                     name=name, daemon=True).start()
+    return target
+
+
+# ─── Главный процесс ──────────────────────────────────────────────────────────
+class ShardRouter:
+    def __init__(self, bot: Bot, workers: int = WORKERS):
+        self.bot = bot
+        ctx = mp.get_context("spawn")
+        self.inboxes = [ctx.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(workers)]
+        self.outbox = ctx.Queue()
+        self.processes = [
+            ctx.Process(target=worker_main, args=(i, inbox, self.outbox),
+                        name=f"bot-worker-{i}", daemon=True)
+            for i, inbox in enumerate(self.inboxes)
+        ]
+        self._reader: asyncio.Task | None = None
+        self._flush_round = 0
+        self._flush_acks = 0
+        self._flushed = asyncio.Event()
+
+    def shard(self, user_id: int) -> int:
+        return user_id % len(self.inboxes)
+
+    async def _put(self, index: int, item: tuple):
+        try:
+            self.inboxes[index].put_nowait(item)
+        except queue.Full:
+            # Воркер не успевает — ждём места, тормозя приём апдейтов
+            await asyncio.to_thread(self.inboxes[index].put, item)
+
+    def _send(self, index: int, item: tuple):
+        try:
+            self.inboxes[index].put_nowait(item)
+        except queue.Full:
+            asyncio.get_running_loop().create_task(self._put(index, item))
+
+    def _broadcast(self, item: tuple, skip: int | None = None):
+        for index in range(len(self.inboxes)):
+            if index != skip:
+                self._send(index, item)
+
+    async def route(self, raw: dict):
+        user_id = user_of(raw)
+        await self._put(self.shard(user_id), ("update", user_id, raw))
+
+    async def _read_outbox(self):
+        messages = read_queue(self.outbox, "shard-outbox")
+        while True:
+            kind, *args = await messages.get()
+            if kind == "stop":
+                return
+            if kind == "invalidate_feed":
+                feed.invalidate(notify=False)
+                self._broadcast(("invalidate_feed",), skip=args[0])
+            elif kind == "push":
+                signal_delivery.schedule_push(self.bot, report_to=args[0])
+            elif kind == "cursors_flushed" and args[0] == self._flush_round:
+                self._flush_acks += 1
+                if self._flush_acks == len(self.inboxes):
+                    self._flushed.set()
+
+    async def flush_cursors(self):
+        """Перед push: несохранённые курсоры воркеров должны быть в БД."""
+        self._flush_round += 1
+        self._flush_acks = 0
+        self._flushed.clear()
+        self._broadcast(("flush_cursors", self._flush_round))
+        try:
+            await asyncio.wait_for(self._flushed.wait(), CURSOR_FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning("⚠️ Workers did not flush signal cursors in %.0fs", CURSOR_FLUSH_TIMEOUT)
+
+    def send_cursors(self, advanced: dict[int, int]):
+        """После push: курсоры уходят в кэш воркеров-владельцев."""
+        by_shard: dict[int, list[tuple[int, int]]] = defaultdict(list)
+        for user_id, signal_id in advanced.items():
+            by_shard[self.shard(user_id)].append((user_id, signal_id))
+        for index, pairs in by_shard.items():
+            self._send(index, ("cursors", pairs))
+
+    async def start(self):
+        for process in self.processes:
+            process.start()
+        user_context.on_invalidate(lambda uid: self._send(self.shard(uid), ("invalidate_user", uid)))
+        feed.on_invalidate(lambda: self._broadcast(("invalidate_feed",)))
+        signal_delivery.on_push(self.flush_cursors, self.send_cursors)
+        self._reader = asyncio.create_task(self._read_outbox())
+        logging.info("🟢 Started %s bot workers", len(self.processes))
+
+    async def stop(self, timeout: float = 30.0):
+        self._broadcast(("stop",))
+        for process in self.processes:
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                logging.warning("⚠️ %s did not stop in time, terminating", process.name)
+                process.terminate()
+        self.outbox.put(("stop",))
+        if self._reader:
+            await self._reader
+
+
+async def poll(bot: Bot, router: ShardRouter, allowed_updates: list[str]):
+    """Long polling в главном процессе: апдейты не разбираются, а уходят воркерам."""
+    await bot.delete_webhook()
+    logging.info("🟢 Telegram polling started (%s workers)", len(router.inboxes))
+    offset, delay = None, 1.0
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT,
+                                            allowed_updates=allowed_updates,
+                                            request_timeout=POLL_TIMEOUT + 10)
+        except Exception as e:
+            logging.warning("⚠️ getUpdates failed: %s, retry in %.0fs", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+            continue
+        delay = 1.0
+        for update in updates:
+            offset = update.update_id + 1
+            await router.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+
+
+# ─── Воркер ───────────────────────────────────────────────────────────────────
+def worker_main(index: int, inbox, outbox):
+    logging.basicConfig(level=logging.INFO,
+                        format=f"%(asctime)s %(levelname)s [worker {index}] %(message)s")
+    asyncio.run(_serve(index, inbox, outbox))
+
+
+async def _serve(index: int, inbox, outbox):
+    from checkout import checkout
+    from fsm_storage import MySQLStorage
+    from handlers import register_handlers
+    from loop_monitor import monitor as loop_monitor
+    from signal_delivery import cursors
+    from user_writes import user_writes
+
+    bot = metrics.instrument_bot(Bot(token=API_TOKEN))
+    dp = Dispatcher(storage=MySQLStorage())
+    register_handlers(dp, bot)
+    feed.on_invalidate(lambda: outbox.put(("invalidate_feed", index)))
+    signal_delivery.delegate_push(lambda report_to: outbox.put(("push", report_to)))
+
+    await loop_monitor.start()
+    await db.init_pool()
+    await cursors.start()
+    await user_writes.start()
+
+    # slots — одновременно выполняемые апдейты; backlog — принятые, но ещё
+    # не обработанные (ждущие своей очереди у пользователя или слота)
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    backlog = asyncio.Semaphore(WORKER_QUEUE_SIZE)
+    tails: dict[int, asyncio.Task] = {}
+    messages = read_queue(inbox, f"shard-inbox-{index}")
+
+    async def process(user_id: int, raw: dict, previous: asyncio.Task | None):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])  # порядок апдейтов одного пользователя
+            # Слот берётся только когда апдейт действительно начинает выполняться:
+            # очередь одного пользователя не занимает слоты остальных
+            async with slots:
+                await dp.feed_raw_update(bot, raw)
+        except Exception:
+            logging.exception("❌ Failed to process update %s", raw.get("update_id"))
+        finally:
+            backlog.release()
+            if tails.get(user_id) is asyncio.current_task():
+                del tails[user_id]
+
+    try:
+        while True:
+            kind, *args = await messages.get()
+            if kind == "update":
+                user_id, raw = args
+                await backlog.acquire()
+                tails[user_id] = asyncio.create_task(process(user_id, raw, tails.get(user_id)))
+            elif kind == "invalidate_user":
+                user_context.invalidate(args[0], notify=False)
+            elif kind == "invalidate_feed":
+                feed.invalidate(notify=False)
+            elif kind == "flush_cursors":
+                try:
+                    await cursors.flush()
+                except Exception:
+                    logging.exception("❌ Failed to flush signal cursors")
+                outbox.put(("cursors_flushed", args[0]))
+            elif kind == "cursors":
+                for user_id, signal_id in args[0]:
+                    cursors.learn(user_id, signal_id)
+            elif kind == "stop":
+                break
+        if tails:
+            await asyncio.wait(list(tails.values()))
+    finally:
+        await checkout.stop()
+        await cursors.stop()
+        await user_writes.stop()
+        await dp.storage.close()
+        await db.close_pool()
+        await bot.session.close()
+        await loop_monitor.stop()
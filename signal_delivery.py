@@ -0,0 +1,319 @@
+"""Доставка только новых сигналов по курсору пользователя.
+
+signal_cursors.last_signal_id — id последнего доставленного пользователю
+сигнала. Курсоры читаются по первичному ключу и кэшируются, а записи
+копятся в памяти и сбрасываются одним multi-row upsert раз в
+CURSOR_FLUSH_INTERVAL секунд или при накоплении CURSOR_FLUSH_SIZE изменений.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from aiogram import Bot
+
+import db
+from broadcast import Broadcaster, BroadcastStats, SENT
+from config import CURSOR_FLUSH_INTERVAL, CURSOR_FLUSH_SIZE, CURSOR_CACHE_MAX
+from locale_utils import load_messages
+from signal_feed import feed, paginate_rows, PAGE_LIMIT
+
+MAX_DELTA_MESSAGES = 3
+UPSERT_CHUNK       = 500
+PROGRESS_INTERVAL  = 2.0
+
+SUBSCRIBERS_SQL = """
+    SELECT u.user_id, u.language, COALESCE(c.last_signal_id, 0)
+      FROM users u
+ LEFT JOIN signal_cursors c ON c.user_id = u.user_id
+     WHERE u.active_until > NOW()
+       AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.user_id = u.user_id)
+       AND u.user_id > %s
+  ORDER BY u.user_id
+     LIMIT %s
+"""
+
+
+# ─── Курсоры ──────────────────────────────────────────────────────────────────
+class CursorStore:
+    def __init__(self, flush_interval: float = CURSOR_FLUSH_INTERVAL,
+                 flush_size: int = CURSOR_FLUSH_SIZE, cache_size: int = CURSOR_CACHE_MAX):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.cache_size = cache_size
+        self._known: "OrderedDict[int, int]" = OrderedDict()
+        self._pending: dict[int, int] = {}
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def _remember(self, user_id: int, signal_id: int):
+        self._known[user_id] = signal_id
+        self._known.move_to_end(user_id)
+        while len(self._known) > self.cache_size:
+            self._known.popitem(last=False)
+
+    def learn(self, user_id: int, signal_id: int):
+        """Курсор, который уже сохранил другой процесс (push в главном процессе):
+        только обновить кэш, свою более старую несохранённую запись — забыть."""
+        if signal_id <= self.peek(user_id):
+            return
+        self._pending.pop(user_id, None)
+        self._remember(user_id, signal_id)
+
+    def peek(self, user_id: int) -> int:
+        return self._pending.get(user_id) or self._known.get(user_id, 0)
+
+    async def get(self, user_id: int) -> int:
+        if user_id in self._pending:
+            return self._pending[user_id]
+        if user_id in self._known:
+            return self._known[user_id]
+        row = await db.fetchone(
+            "SELECT last_signal_id FROM signal_cursors WHERE user_id=%s", (user_id,)
+        )
+        cursor = row[0] if row else 0
+        self._remember(user_id, max(cursor, self.peek(user_id)))
+        return self._known[user_id]
+
+    def advance(self, user_id: int, signal_id: int):
+        if signal_id <= self.peek(user_id):
+            return
+        self._pending[user_id] = signal_id
+        self._remember(user_id, signal_id)
+        if len(self._pending) >= self.flush_size:
+            self._wake.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            items = list(batch.items())
+            try:
+                for i in range(0, len(items), UPSERT_CHUNK):
+                    chunk = items[i:i + UPSERT_CHUNK]
+                    values = ", ".join(["(%s, %s)"] * len(chunk))
+                    await db.execute(
+                        "INSERT INTO signal_cursors (user_id, last_signal_id) VALUES " + values +
+                        " ON DUPLICATE KEY UPDATE last_signal_id = GREATEST(last_signal_id, VALUES(last_signal_id))",
+                        [arg for pair in chunk for arg in pair]
+                    )
+            except Exception:
+                # Вернуть несохранённое, не затирая более свежие значения
+                for user_id, signal_id in batch.items():
+                    if signal_id > self._pending.get(user_id, 0):
+                        self._pending[user_id] = signal_id
+                raise
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("❌ Failed to flush signal cursors")
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+cursors = CursorStore()
+
+
+async def pending_pages(user_id: int) -> tuple[tuple[str, int], ...]:
+    """Новые для пользователя сигналы, от новых к старым, разбитые на страницы.
+
+    Первая страница — самые свежие сигналы: при большом отставании (или без
+    курсора) пользователь видит последние, а не самые старые из пропущенных."""
+    rows = await feed.since(await cursors.get(user_id))
+    return paginate_rows(rows)
+
+
+# ─── Push новых сигналов подписчикам ──────────────────────────────────────────
+class _DeliveryLog:
+    """Пакетная запись статусов доставки в signal_deliveries."""
+
+    def __init__(self):
+        self._rows: list[tuple[int, int, str]] = []
+
+    def add(self, signal_id: int, user_id: int, status: str):
+        self._rows.append((signal_id, user_id, status))
+
+    def due(self) -> bool:
+        return len(self._rows) >= UPSERT_CHUNK
+
+    async def flush(self):
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        values = ", ".join(["(%s, %s, %s, NOW())"] * len(rows))
+        await db.execute(
+            "INSERT INTO signal_deliveries (signal_id, user_id, status, delivered_at) VALUES " + values +
+            " ON DUPLICATE KEY UPDATE status = VALUES(status), delivered_at = VALUES(delivered_at)",
+            [arg for row in rows for arg in row]
+        )
+
+
+def _progress_text(stats: BroadcastStats, posted_at: float, done: bool) -> str:
+    head = "✅ Рассылка сигнала завершена" if done else "📤 Рассылка сигнала…"
+    lines = [
+        head,
+        f"Доставлено: {stats.sent}/{stats.total}, ошибок: {stats.failed}, "
+        f"заблокировали: {stats.blocked}",
+    ]
+    if stats.first_sent is not None:
+        lines.append(f"Первая доставка: {stats.first_sent - posted_at:.2f} c после публикации")
+    if done and stats.last_sent is not None:
+        lines.append(f"Последняя доставка: {stats.last_sent - posted_at:.2f} c после публикации")
+    lines.append(f"Скорость: {stats.rate:.1f} msg/s")
+    return "\n".join(lines)
+
+
+async def _report(bot: Bot, chat_id: int, message_id: int, stats: BroadcastStats,
+                  posted_at: float, stop: asyncio.Event):
+    last = None
+    while True:
+        done = stop.is_set()
+        text = _progress_text(stats, posted_at, done)
+        if text != last:
+            try:
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+                last = text
+            except Exception as e:
+                logging.debug("Progress update failed: %s", e)
+        if done:
+            return
+        try:
+            await asyncio.wait_for(stop.wait(), PROGRESS_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def push_new_signals(bot: Bot, reports: list[tuple[int, int, float]] = ()) -> BroadcastStats:
+    """Fan-out новых сигналов активным подписчикам.
+
+    Текст рендерится один раз на (язык, курсор) — в обычном случае у всех
+    подписчиков одинаковый курсор, и на язык приходится один рендер.
+    reports — (chat_id, message_id, posted_at) сообщений админа с прогрессом.
+    """
+    if _before_push is not None:
+        await _before_push()
+    snapshot = await feed.since(0)
+    advanced: dict[int, int] = {}
+    rendered: dict[tuple[str, int], tuple[dict, int] | None] = {}
+    delivered_upto: dict[int, int] = {}
+    log = _DeliveryLog()
+
+    def render(lang: str, cursor: int) -> tuple[dict, int] | None:
+        rows = [row for row in snapshot if row[0] > cursor]
+        if not rows:
+            return None
+        header = load_messages(lang)["new_signal_header"]
+        # snapshot от новых к старым: первая страница всегда содержит новый сигнал,
+        # более старые пропущенные остаются в ленте
+        text, upto = paginate_rows(rows, PAGE_LIMIT - len(header) - 2)[0]
+        return {"text": f"{header}\n\n{text}"}, upto
+
+    def build(user_id: int, lang: str, cursor: int) -> dict | None:
+        cursor = max(cursor, cursors.peek(user_id))
+        key = (lang, cursor)
+        if key not in rendered:
+            rendered[key] = render(lang, cursor)
+        if rendered[key] is None:
+            return None
+        payload, delivered_upto[user_id] = rendered[key]
+        return payload
+
+    def on_result(user_id: int, payload: dict, status: str):
+        upto = delivered_upto.pop(user_id)
+        log.add(upto, user_id, status)
+        if status == SENT:
+            cursors.advance(user_id, upto)
+            advanced[user_id] = upto
+        if log.due():
+            flushes.append(asyncio.create_task(log.flush()))
+
+    flushes: list[asyncio.Task] = []
+    stats = BroadcastStats("signal_push")
+    stop = asyncio.Event()
+    reporters = [
+        asyncio.create_task(_report(bot, chat_id, message_id, stats, posted_at, stop))
+        for chat_id, message_id, posted_at in reports
+    ]
+    try:
+        await Broadcaster(bot).run(
+            "signal_push",
+            lambda start_after: db.iter_keyset(SUBSCRIBERS_SQL, start_after=start_after),
+            build, resume=False, on_result=on_result, stats=stats,
+        )
+    finally:
+        flushes.append(asyncio.create_task(log.flush()))
+        await asyncio.gather(*flushes, return_exceptions=True)
+        if _after_push is not None and advanced:
+            _after_push(advanced)
+        stop.set()
+        await asyncio.gather(*reporters, return_exceptions=True)
+    if reports:
+        posted_at = min(p for _, _, p in reports)
+        if stats.last_sent is not None:
+            logging.info("📡 Signal fan-out: last delivery %.2fs after post", stats.last_sent - posted_at)
+    return stats
+
+
+_push_task: asyncio.Task | None = None
+_waiting: list[tuple[int, int, float]] = []
+
+# Режим с воркерами (shard.py): push идёт только в главном процессе. Воркер
+# передаёт ему запуск; перед рассылкой воркеры сбрасывают свои курсоры в БД,
+# после неё получают новые курсоры своих пользователей.
+_delegate: Callable[[tuple[int, int] | None], None] | None = None
+_before_push: Callable[[], Awaitable[None]] | None = None
+_after_push: Callable[[dict[int, int]], None] | None = None
+
+
+def delegate_push(fn: Callable[[tuple[int, int] | None], None]):
+    global _delegate
+    _delegate = fn
+
+
+def on_push(before: Callable[[], Awaitable[None]], after: Callable[[dict[int, int]], None]):
+    global _before_push, _after_push
+    _before_push, _after_push = before, after
+
+
+def schedule_push(bot: Bot, report_to: tuple[int, int] | None = None):
+    """Запустить push в фоне. Сигналы, добавленные во время рассылки,
+    уйдут следующим проходом сразу после текущего.
+
+    report_to — (chat_id, message_id) сообщения, в котором показывать прогресс.
+    """
+    global _push_task
+    if _delegate is not None:
+        _delegate(report_to)
+        return
+    _waiting.append((*report_to, time.monotonic()) if report_to else None)
+    if _push_task and not _push_task.done():
+        return
+
+    async def runner():
+        while _waiting:
+            reports = [r for r in _waiting if r is not None]
+            _waiting.clear()
+            try:
+                await push_new_signals(bot, reports)
+            except Exception:
+                logging.exception("❌ Signal push failed")
+
+    _push_task = asyncio.create_task(runner())
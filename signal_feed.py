@@ -0,0 +1,126 @@
+import asyncio
+from functools import lru_cache
+from itertools import takewhile
+from typing import Callable
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+import db
+
+# Лимит Telegram — 4096 символов, оставляем запас
+PAGE_LIMIT  = 4000
+SEPARATOR   = "\n\n"
+FEED_PREFIX = "feed:"
+
+# id растёт вместе с created_at; сортировка по PK нужна для курсоров доставки
+# Лента целиком кэшируется в памяти, полное чтение таблицы — намеренно
+SIGNALS_SQL = "SELECT id, text FROM signals ORDER BY id DESC /* full-scan-ok */"
+
+
+def _pack(texts, limit: int) -> list[list[str]]:
+    groups, current, size = [], [], 0
+    for text in texts:
+        item = f"📌 {text}"
+        if len(item) > limit:
+            item = item[:limit - 1] + "…"
+        extra = len(item) + (len(SEPARATOR) if current else 0)
+        if current and size + extra > limit:
+            groups.append(current)
+            current, size = [], 0
+            extra = len(item)
+        current.append(item)
+        size += extra
+    if current:
+        groups.append(current)
+    return groups
+
+
+def paginate(texts, limit: int = PAGE_LIMIT) -> tuple[str, ...]:
+    return tuple(SEPARATOR.join(group) for group in _pack(texts, limit))
+
+
+def paginate_rows(rows, limit: int = PAGE_LIMIT) -> tuple[tuple[str, int], ...]:
+    """Как paginate(), но для строк (id, text): каждая страница со своим max(id),
+    чтобы курсор доставки двигался ровно до последнего отправленного сигнала."""
+    rows = tuple(rows)
+    pages, start = [], 0
+    for group in _pack((text for _, text in rows), limit):
+        chunk = rows[start:start + len(group)]
+        pages.append((SEPARATOR.join(group), max(signal_id for signal_id, _ in chunk)))
+        start += len(group)
+    return tuple(pages)
+
+
+FULL_FEED_KB = InlineKeyboardMarkup(inline_keyboard=[[
+    InlineKeyboardButton(text="📜 Вся лента", callback_data=f"{FEED_PREFIX}0")
+]])
+
+
+@lru_cache(maxsize=512)
+def page_kb(page: int, total: int) -> InlineKeyboardMarkup | None:
+    if total <= 1:
+        return None
+    prev_page = (page - 1) % total
+    next_page = (page + 1) % total
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="◀️", callback_data=f"{FEED_PREFIX}{prev_page}"),
+        InlineKeyboardButton(text=f"{page + 1}/{total}", callback_data=f"{FEED_PREFIX}noop"),
+        InlineKeyboardButton(text="▶️", callback_data=f"{FEED_PREFIX}{next_page}"),
+    ]])
+
+
+class SignalFeed:
+    """Лента сигналов, заранее разбитая на страницы.
+
+    Собирается одним запросом при первом обращении и живёт в памяти до
+    invalidate() (add_signal / clear_signals). Параллельные промахи ждут
+    одну загрузку; загрузка, начатая до invalidate(), результат не сохраняет.
+    """
+
+    def __init__(self):
+        self._pages: tuple[str, ...] | None = None
+        self._rows: tuple[tuple[int, str], ...] = ()
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self._listeners: list[Callable[[], None]] = []
+
+    def on_invalidate(self, listener: Callable[[], None]):
+        self._listeners.append(listener)
+
+    def invalidate(self, notify: bool = True):
+        self._generation += 1
+        self._pages = None
+        if notify:
+            for listener in self._listeners:
+                listener()
+
+    async def _snapshot(self) -> tuple[tuple, tuple[str, ...]]:
+        if self._pages is not None:
+            return self._rows, self._pages
+        async with self._lock:
+            if self._pages is not None:
+                return self._rows, self._pages
+            generation = self._generation
+            rows = tuple(await db.fetchall(SIGNALS_SQL))
+            pages = paginate(text for _, text in rows)
+            if generation == self._generation:
+                self._rows, self._pages = rows, pages
+            return rows, pages
+
+    async def pages(self) -> tuple[str, ...]:
+        return (await self._snapshot())[1]
+
+    async def since(self, signal_id: int) -> tuple[tuple[int, str], ...]:
+        """Сигналы новее signal_id, от новых к старым."""
+        rows, _ = await self._snapshot()
+        return tuple(takewhile(lambda row: row[0] > signal_id, rows))
+
+    async def page(self, index: int) -> tuple[str | None, InlineKeyboardMarkup | None]:
+        pages = await self.pages()
+        if not pages:
+            return None, None
+        index = max(0, min(index, len(pages) - 1))
+        return pages[index], page_kb(index, len(pages))
+
+
+feed = SignalFeed()
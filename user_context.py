@@ -0,0 +1,98 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+import db
+from config import USER_CONTEXT_TTL, USER_CONTEXT_MAX
+from user_writes import user_writes
+
+CONTEXT_SQL = """
+    SELECT u.user_id IS NOT NULL,
+           u.language,
+           u.email,
+           u.active_until,
+           COALESCE(u.active_until > NOW(), 0),
+           COALESCE(a.is_authorized, 0)
+      FROM (SELECT %s AS user_id) q
+ LEFT JOIN users  u ON u.user_id = q.user_id
+ LEFT JOIN admins a ON a.user_id = q.user_id
+"""
+
+
+@dataclass(frozen=True, slots=True)
+class UserContext:
+    user_id: int
+    registered: bool
+    language: str
+    email: str | None
+    is_admin: bool
+    active_until: datetime | None
+    has_access: bool
+
+
+# ─── TTL-кэш ──────────────────────────────────────────────────────────────────
+_cache: "OrderedDict[int, tuple[float, UserContext]]" = OrderedDict()
+_listeners: list[Callable[[int], None]] = []
+
+
+def on_invalidate(listener: Callable[[int], None]):
+    """Слушатель сбросов — так сброс доходит до процесса-владельца пользователя."""
+    _listeners.append(listener)
+
+
+def invalidate(user_id: int, notify: bool = True):
+    _cache.pop(user_id, None)
+    if notify:
+        for listener in _listeners:
+            listener(user_id)
+
+
+async def load_context(user_id: int) -> UserContext:
+    now = time.monotonic()
+    hit = _cache.get(user_id)
+    if hit and hit[0] > now:
+        _cache.move_to_end(user_id)
+        return hit[1]
+
+    await user_writes.sync(user_id)  # несброшенные изменения регистрации
+    registered, lang, email, active_until, has_access, is_admin = await db.fetchone(
+        CONTEXT_SQL, (user_id,)
+    )
+    ctx = UserContext(
+        user_id=user_id,
+        registered=bool(registered),
+        language=lang or "en",
+        email=email,
+        is_admin=bool(is_admin),
+        active_until=active_until,
+        has_access=bool(has_access),
+    )
+    _cache[user_id] = (now + USER_CONTEXT_TTL, ctx)
+    _cache.move_to_end(user_id)
+    while len(_cache) > USER_CONTEXT_MAX:
+        _cache.popitem(last=False)
+    return ctx
+
+
+# ─── Middleware ───────────────────────────────────────────────────────────────
+class UserContextMiddleware(BaseMiddleware):
+    """Кладёт UserContext в data["ctx"], если хэндлер принимает аргумент ctx.
+    Вешается как inner middleware — фильтры уже отработали, и хэндлерам
+    без ctx запрос в БД не нужен вовсе."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        handler_obj = data.get("handler")
+        if user and handler_obj is not None and "ctx" in handler_obj.params:
+            data["ctx"] = await load_context(user.id)
+        return await handler(event, data)
@@ -0,0 +1,178 @@
+"""Запись профиля пользователя при регистрации: язык, имя и email, сброс.
+
+По умолчанию каждая запись сразу идёт в БД, как раньше. С USER_WRITE_BEHIND=1
+изменения копятся в памяти по пользователю (последнее значение побеждает) и
+сбрасываются одной транзакцией из multi-row запросов раз в USER_FLUSH_INTERVAL
+секунд или при накоплении USER_FLUSH_SIZE пользователей — при наплыве /start
+БД делает один коммит на пачку, а не на каждый шаг регистрации.
+
+Чтение своих записей: load_context перед походом в БД дожидается сброса
+изменений этого пользователя (процесс-владелец у пользователя один, см.
+shard.py). При остановке несохранённое сбрасывается в stop().
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+
+import db
+import metrics
+from config import USER_WRITE_BEHIND, USER_FLUSH_INTERVAL, USER_FLUSH_SIZE
+
+UPSERT_CHUNK = 500
+
+FLUSHED = metrics.Counter("bot_user_writes_flushed_total", "Buffered profile writes flushed to DB")
+
+
+@dataclass
+class PendingUser:
+    deleted: bool = False                # строку удалить до остальных изменений
+    language: str | None = None
+    contact: tuple[str, str] | None = None  # (username, email)
+
+    def then(self, newer: "PendingUser") -> "PendingUser":
+        """Итог двух последовательных наборов изменений."""
+        if newer.deleted:
+            return newer
+        merged = PendingUser(self.deleted, newer.language or self.language, newer.contact or self.contact)
+        if merged.deleted and merged.language is None:
+            merged.contact = None  # UPDATE удалённой строки ничего не меняет
+        return merged
+
+
+def _in(values) -> str:
+    return ", ".join(["%s"] * len(values))
+
+
+def _chunks(items: list) -> list[list]:
+    return [items[i:i + UPSERT_CHUNK] for i in range(0, len(items), UPSERT_CHUNK)]
+
+
+class UserWriteBuffer:
+    def __init__(self, enabled: bool = USER_WRITE_BEHIND, flush_interval: float = USER_FLUSH_INTERVAL,
+                 flush_size: int = USER_FLUSH_SIZE):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending: dict[int, PendingUser] = {}
+        self._writing: dict[int, PendingUser] = {}
+        self._dirty = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def _add(self, user_id: int, change: PendingUser):
+        current = self._pending.get(user_id)
+        self._pending[user_id] = current.then(change) if current else change
+        self._dirty.set()
+        if len(self._pending) >= self.flush_size:
+            self._full.set()
+
+    # ─── Изменения ────────────────────────────────────────────────────────────
+    async def set_language(self, user_id: int, lang: str):
+        """Создаёт пользователя или меняет язык; снимает отметку о блокировке."""
+        if not self.enabled:
+            return await db.save_language(user_id, lang)
+        self._add(user_id, PendingUser(language=lang))
+
+    async def set_contact(self, user_id: int, username: str, email: str):
+        if not self.enabled:
+            await db.execute(
+                "UPDATE users SET username=%s, email=%s WHERE user_id=%s",
+                (username, email, user_id)
+            )
+            return
+        self._add(user_id, PendingUser(contact=(username, email)))
+
+    async def delete(self, user_id: int):
+        if not self.enabled:
+            await db.execute("DELETE FROM users WHERE user_id=%s", (user_id,))
+            return
+        self._add(user_id, PendingUser(deleted=True))
+
+    def depth(self) -> int:
+        """Пользователей с изменениями, ещё не записанными в БД."""
+        return len(self._pending) + len(self._writing)
+
+    async def sync(self, user_id: int):
+        """Дожидается, пока изменения пользователя окажутся в БД."""
+        if user_id in self._pending or user_id in self._writing:
+            await self.flush()
+
+    # ─── Сброс ────────────────────────────────────────────────────────────────
+    async def _write(self, batch: dict[int, PendingUser]):
+        deleted = [uid for uid, change in batch.items() if change.deleted]
+        upserts = [
+            (uid, change.language, *(change.contact or (None, None)))
+            for uid, change in batch.items() if change.language is not None
+        ]
+        updates = [
+            (*change.contact, uid)
+            for uid, change in batch.items() if change.language is None and change.contact
+        ]
+        async with db.transaction() as conn:
+            for chunk in _chunks(deleted):
+                await conn.execute(f"DELETE FROM users WHERE user_id IN ({_in(chunk)})", chunk)
+            for chunk in _chunks(upserts):
+                # NULL в username/email — «не менялось», старое значение остаётся
+                await conn.execute(
+                    "INSERT INTO users (user_id, language, username, email) VALUES " +
+                    ", ".join(["(%s, %s, %s, %s)"] * len(chunk)) +
+                    " ON DUPLICATE KEY UPDATE language = VALUES(language),"
+                    " username = COALESCE(VALUES(username), username),"
+                    " email = COALESCE(VALUES(email), email)",
+                    [arg for row in chunk for arg in row]
+                )
+                ids = [row[0] for row in chunk]
+                await conn.execute(f"DELETE FROM blocked_users WHERE user_id IN ({_in(ids)})", ids)
+            if updates:
+                await conn.executemany("UPDATE users SET username=%s, email=%s WHERE user_id=%s", updates)
+
+    async def flush(self):
+        async with self._flush_lock:
+            self._dirty.clear()
+            self._full.clear()
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            self._writing = batch
+            try:
+                await self._write(batch)
+            except Exception:
+                # Вернуть несохранённое под более свежие изменения
+                for user_id, change in batch.items():
+                    newer = self._pending.get(user_id)
+                    self._pending[user_id] = change.then(newer) if newer else change
+                self._dirty.set()
+                raise
+            finally:
+                self._writing = {}
+            FLUSHED.inc(value=len(batch))
+
+    async def _loop(self):
+        while True:
+            await self._dirty.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("❌ Failed to flush user profile writes")
+                await asyncio.sleep(1.0)
+
+    async def start(self):
+        if self.enabled:
+            self._task = asyncio.create_task(self._loop())
+            logging.info("🟢 User profile write-behind enabled (%.0f ms)", self.flush_interval * 1000)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+user_writes = UserWriteBuffer()
+
+metrics.Gauge("bot_user_writes_pending", "Profile writes waiting for flush", fn=user_writes.depth)
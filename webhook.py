@@ -0,0 +1,79 @@
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from config import WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_CONCURRENCY
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookHandler:
+    """Приём апдейтов Telegram на том же aiohttp-приложении, что и IPN.
+
+    Апдейт обрабатывается в фоне, ответ Telegram уходит сразу. Семафор
+    ограничивает число одновременно обрабатываемых апдейтов: когда он занят,
+    ответ задерживается и Telegram сам снижает темп доставки.
+    С router (shard.ShardRouter) апдейт не разбирается, а уходит воркеру.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str | None = WEBHOOK_SECRET,
+                 concurrency: int = WEBHOOK_CONCURRENCY, router=None):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.router = router
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: set[asyncio.Task] = set()
+
+    async def _process(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            logging.exception("❌ Failed to process update %s", update.update_id)
+        finally:
+            self._slots.release()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        # Без настроенного секрета апдейты не принимаются вовсе
+        if not self.secret or not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401, text="Unauthorized")
+
+        raw = await request.json(loads=self.bot.session.json_loads)
+        if self.router is not None:
+            await self.router.route(raw)
+            return web.Response()
+
+        update = Update.model_validate(raw, context={"bot": self.bot})
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def setup_webhook(app: web.Application, dp: Dispatcher, bot: Bot, router=None) -> WebhookHandler:
+    handler = WebhookHandler(dp, bot, router=router)
+    app.router.add_post(WEBHOOK_PATH, handler.handle)
+
+    async def on_startup(app: web.Application):
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info("🟢 Telegram webhook set on %s", WEBHOOK_PATH)
+
+    async def on_shutdown(app: web.Application):
+        await handler.drain()
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return handler